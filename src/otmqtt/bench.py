@@ -0,0 +1,190 @@
+#! /usr/bin/env python3
+"""Microbenchmarks of the frame decoding and discovery generation.
+
+Each benchmark runs on a fixed corpus of frames, the result is the best
+time per operation in ns out of a few repeats, over 3 rounds of the suite.
+
+Absolute times vary with the machine and its load, so the comparison with
+the baseline is normalised: each result is divided by the time of a fixed
+calibration loop, run in the same process before and after every
+benchmark. The baseline stores the calibration time with the results.
+
+Usage:
+  otmqtt-bench                      compare with baseline, fail on regression
+  otmqtt-bench --update             store results as new baseline
+  python -m otmqtt.bench -t 0.25    allow 25% regression
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from . import serializer
+from .hass_discovery import HassDiscovery
+from .opentherm import OpenThermApplProtocol
+from .ot_registers import OT
+
+# Fixed frame corpora per SubClass, (Read-Ack) frames as seen on the bus
+CORPUS = {
+    "OT_f88_C": [0x40191980, 0x401a2d00, 0x40190000, 0xc01bfe80],
+    "OT_f8f8": [0x40000308, 0xc0000300, 0xc0060303, 0xc0000009],
+    "OT_f8u8": [0x40030109, 0xc0050000, 0x40050103, 0x40032000],
+    "OT_u8u8_dual": [0x407e0302, 0x407f0102, 0x40151304, 0xc00c0000],
+    "OT_s8s8_dual_C": [0xc0304b28, 0x40315a1e, 0x4030ff80, 0x40310000],
+    "OT_reg_20": [0xc0146a1e, 0xc0140000, 0xc014e33b, 0x40142c05],
+    "OT_reg_33": [0xc0210050, 0xc021ff9c, 0xc0210000, 0x40217fff],
+    "OT_reg_100": [0xc0640100, 0x40640003, 0x40640000, 0xc0640203],
+}
+
+ALL_FRAMES = [f for frames in CORPUS.values() for f in frames]
+
+
+CALIBRATION = "_calibration"
+
+
+def calibration_loop():
+    """Fixed mix of the operations of decoding: ints, floats, dicts, strings."""
+    d = {}
+    for i in range(64):
+        v = (i << 8 | i) / 256.0
+        d[f"k{i & 7}"] = round(v, 2) if i & 1 else str(v)
+    return d
+
+
+def bench(func, number, repeat=5):
+    """Best time per call in ns."""
+    t = min(timeit.repeat(func, number=number, repeat=repeat))
+    return 1e9 * t / number
+
+
+class Calibrated:
+    """Benchmarks interleaved with the calibration loop, best of all runs."""
+
+    def __init__(self, number):
+        self.number = number
+        self.calibration = float("inf")
+
+    def calibrate(self):
+        self.calibration = min(self.calibration,
+                               bench(calibration_loop, max(1, self.number // 4)))
+        return
+
+    def __call__(self, func, number):
+        self.calibrate()
+        t = bench(func, number)
+        self.calibrate()
+        return t
+
+
+def run(number=1000, rounds=3):
+    """Run all benchmarks, return dict name -> ns per frame or DataObject.
+
+    The suite runs 'rounds' times, the best result of each benchmark is
+    kept: a disturbance hits one round, not all of them.
+    """
+    results = {}
+    for _ in range(rounds):
+        for name, ns in run_once(number).items():
+            results[name] = min(ns, results.get(name, ns))
+    return results
+
+
+def run_once(number):
+    """One round of all benchmarks."""
+    OpenThermApplProtocol.OT = OT
+    OpenThermApplProtocol.hass_prefix = "homeassistant"
+    serializer.set_encoder("json")
+    OpenThermApplProtocol.clear_payloads()
+    timed = Calibrated(number)
+    results = {}
+    n = len(ALL_FRAMES)
+    results["from_frame"] = timed(
+        lambda: [OpenThermApplProtocol.from_frame(f) for f in ALL_FRAMES], number) / n
+    for subcl, frames in CORPUS.items():
+        objs = [OpenThermApplProtocol.from_frame(f) for f in frames]
+        results[f"decode_payload.{subcl}"] = timed(
+            lambda: [o.decode_payload() for o in objs], number) / len(objs)
+    objs = [OpenThermApplProtocol.from_frame(f) for f in CORPUS["OT_f8f8"]]
+    results["flags_payload"] = timed(
+        lambda: [o.flags_payload(OT[o.data_id()]["lflags"]) for o in objs], number) / len(objs)
+    # Discovery per (sub-)DataObject
+    objs = [OpenThermApplProtocol.from_frame(f) for f in ALL_FRAMES]
+    dobjs = [(o, {"DataObject": d})
+             for o in objs for d in OT[o.data_id()]["DataObject"]
+             if isinstance(OT[o.data_id()]["DataObject"], list)]
+    dobjs += [(o, {}) for o in objs if isinstance(OT[o.data_id()]["DataObject"], str)]
+    n = len(dobjs)
+    results["discovery_topic"] = timed(
+        lambda: [o.discovery_topic("s", topic=t) for o, t in dobjs], number) / n
+    results["discovery_payload"] = timed(
+        lambda: [o.discovery_payload("s", topic=t) for o, t in dobjs], number) / n
+    dms = [HassDiscovery(o.discovery_topic("s", topic=t), o.discovery_payload("s", topic=t))
+           for o, t in dobjs]
+    results["HassDiscovery.serialize"] = timed(
+        lambda: [serializer.text_dumps(dm) for dm in dms], number) / n
+    results[CALIBRATION] = timed.calibration
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print results against baseline, return names of regressed benchmarks.
+
+    The ratios are relative to the calibration time of each run.
+    """
+    regressed = []
+    scale = baseline.get(CALIBRATION, results[CALIBRATION]) / results[CALIBRATION]
+    print(f"{'calibration':32} {results[CALIBRATION]:9.0f} ns  {1 / scale:6.2f}x")
+    for name, ns in results.items():
+        base = baseline.get(name)
+        if name == CALIBRATION:
+            continue
+        if base is None:
+            print(f"{name:32} {ns:9.0f} ns  (no baseline)")
+            continue
+        ratio = ns * scale / base
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  REGRESSION"
+            regressed.append(name)
+        print(f"{name:32} {ns:9.0f} ns  {ratio:6.2f}x{mark}")
+    return regressed
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog="otmqtt-bench",
+        description="Microbenchmarks of OpenTherm decoding and discovery.")
+    parser.add_argument("-b", "--baseline", metavar="bench_baseline.json",
+                        default="bench_baseline.json",
+                        help="file with baseline results")
+    parser.add_argument("-t", "--threshold", type=float, default=0.5,
+                        help="allowed relative regression (def. 0.5)")
+    parser.add_argument("-n", "--number", type=int, default=1000,
+                        help="iterations per repeat (def. 1000)")
+    parser.add_argument("-r", "--rounds", type=int, default=3,
+                        help="rounds of the whole suite (def. 3)")
+    parser.add_argument("-u", "--update", action='store_true',
+                        help="store the results as new baseline.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    results = run(args.number, args.rounds)
+    if args.update or not os.path.exists(args.baseline):
+        with open(args.baseline, "w") as f:
+            json.dump({k: round(v, 1) for k, v in results.items()}, f, indent=2)
+        print(f"Baseline written to '{args.baseline}'")
+        compare(results, results, args.threshold)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressed = compare(results, baseline, args.threshold)
+    if regressed:
+        print(f"{len(regressed)} benchmark(s) regressed more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
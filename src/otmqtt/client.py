@@ -0,0 +1,32 @@
+#! /usr/bin/env python3
+"""MQTT client which keeps what the broker sent in its CONNACK.
+
+aiomqtt does not expose the CONNACK flags and properties, such as whether
+the session was resumed and the Topic Alias Maximum of the broker.
+"""
+import aiomqtt
+import paho.mqtt.client as mqtt
+
+
+class Client(aiomqtt.Client):
+    """aiomqtt.Client with the negotiated limits of the connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connack = None  # CONNACK properties
+        self.session_present = False
+        self.topic_alias_maximum = 0
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties=None):
+        if not self._connected.done() and reason_code == mqtt.CONNACK_ACCEPTED:
+            self.connack = properties
+            self.session_present = bool(flags.session_present)
+            self.topic_alias_maximum = getattr(properties, "TopicAliasMaximum", 0) or 0
+        return super()._on_connect(client, userdata, flags, reason_code, properties)
+
+    def limits(self):
+        """The limits of the broker in the CONNACK, as far as given."""
+        names = ("TopicAliasMaximum", "ReceiveMaximum", "MaximumPacketSize",
+                 "MaximumQoS", "RetainAvailable", "SharedSubscriptionAvailable")
+        return {n: getattr(self.connack, n) for n in names
+                if hasattr(self.connack, n)}
@@ -0,0 +1,335 @@
+#! /usr/bin/env python3
+"""Scale-out over several otmqtt instances, with leader election.
+
+Enabled with 'instance' (a unique name) in the [Cluster] section of the
+config file. Each gateway is owned by one instance, which subscribes to
+its topics: all frames of a gateway are decoded by the same instance, so
+its cache of the last values is complete. The leader assigns the gateways,
+see 'Assignment', and publishes '<topic>/state'.
+
+Election through the retained claim on '<topic>/leader', the name of the
+leader, with a Message Expiry Interval of 'lease' seconds:
+- the leader renews its claim every lease/3 seconds
+- without a claim after startup, an instance claims the leadership
+- the last claim received wins, the broker delivers claims in the same
+  order to all instances
+- all instances have '<topic>/state' offline as last will: the leader
+  answers 'offline' by publishing 'online' and renewing its claim, the
+  other instances claim the leadership if no renewal follows
+"""
+import asyncio
+import collections
+import json
+import logging
+import random
+import time
+from .fleet import HashRing
+
+logger = logging.getLogger(__name__)
+
+
+class Election:
+    """Leader election of 'instance' on topic '<t_ot>/leader'."""
+
+    def __init__(self, instance, t_ot, lease=30.0, on_change=None):
+        self.instance = instance
+        self.t_ot = t_ot
+        self.topic = f"{t_ot}/leader"
+        self.lease = lease
+        self.on_change = on_change  # Called with is_leader on a change
+        self.leader = None
+        self.claims = 0  # Claims received
+        self.suspect = False  # Leader might be gone
+        self.online = False  # '<t_ot>/state' online published as leader
+        self.event = asyncio.Event()
+
+    @property
+    def is_leader(self):
+        return self.leader == self.instance
+
+    def properties(self):
+        from paho.mqtt.packettypes import PacketTypes
+        from paho.mqtt.properties import Properties
+        props = Properties(PacketTypes.PUBLISH)
+        props.MessageExpiryInterval = int(self.lease)
+        return props
+
+    async def claim(self, client):
+        await client.publish(self.topic, payload=self.instance, retain=True,
+                             properties=self.properties())
+        return
+
+    def on_leader(self, payload):
+        """Claim 'payload' received on the leader topic."""
+        was = self.is_leader
+        self.leader = payload.decode("utf-8") if payload else None
+        self.claims += 1
+        self.suspect = False
+        if self.is_leader != was:
+            self.online = False
+            self.event.set()
+            logger.warning(f"{self.instance}: {'leader' if self.is_leader else 'follower'}"
+                           f", leader {self.leader}")
+            if self.on_change:
+                self.on_change(self.is_leader)
+        return
+
+    async def on_state(self, client, payload, retained=False):
+        """Message on '<t_ot>/state', 'offline' is the last will of an instance.
+
+        A retained 'offline' is old news, from before this instance started.
+        """
+        if payload != b"offline" or retained:
+            return
+        if self.is_leader:
+            await client.publish(f"{self.t_ot}/state", payload="online", retain=True)
+            await self.claim(client)
+        else:
+            self.suspect = True
+            self.event.set()
+        return
+
+    async def run(self, client, grace=2.0):
+        """Claim or renew the leadership, until cancelled."""
+        await asyncio.sleep(grace)  # Receive the retained claim, if any
+        while True:
+            if self.leader is None:
+                # Jitter to avoid simultaneous claims
+                await asyncio.sleep(random.uniform(0, grace))
+                if self.leader is None:
+                    await self.claim(client)
+            elif self.is_leader:
+                if not self.online:
+                    self.online = True
+                    await client.publish(f"{self.t_ot}/state", payload="online", retain=True)
+                await self.claim(client)
+            elif self.suspect:
+                # Give the leader a chance to renew, jitter to avoid claim storms
+                claims = self.claims
+                await asyncio.sleep(random.uniform(0.5, 1.5) * grace)
+                if self.suspect and self.claims == claims:
+                    await self.claim(client)
+                self.suspect = False
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), self.lease / 3)
+            except asyncio.TimeoutError:
+                pass
+
+
+class Assignment:
+    """Gateways of the cluster, each assigned to one instance by the leader.
+
+    All instances publish their name on '<t_ot>/member' every lease/3
+    seconds. The leader assigns the gateways to the instances heard within
+    the last 'lease' seconds by consistent hashing, published retained on
+    '<t_ot>/assign' as JSON {OTGW_topic: instance}. A crashed instance
+    loses its gateways after at most 'lease' seconds.
+    """
+
+    def __init__(self, instance, t_ot, gateways, lease=30.0):
+        self.instance = instance
+        self.topic = f"{t_ot}/assign"
+        self.member_topic = f"{t_ot}/member"
+        self.gateways = sorted(gateways)
+        self.lease = lease
+        self.members = {}  # instance -> time.monotonic() of its last heartbeat
+        self.assigned = {}  # OTGW_topic -> instance, as published by the leader
+        self.owned = None  # Own gateways, None before the first change
+        self.event = asyncio.Event()
+
+    def owns(self, gateway):
+        return self.assigned.get(gateway) == self.instance
+
+    def on_member(self, payload):
+        """Heartbeat 'payload' received on the member topic."""
+        self.members[payload.decode("utf-8")] = time.monotonic()
+        return
+
+    def on_assign(self, payload):
+        """Assignment 'payload' received on the assign topic."""
+        try:
+            assigned = json.loads(payload) if payload else {}
+        except ValueError as e:
+            logger.error(f"{self.instance}: invalid assignment {payload!r}: {e}")
+            return
+        if isinstance(assigned, dict):
+            self.assigned = assigned
+            self.event.set()
+        return
+
+    def plan(self, now):
+        """Assignment over the live instances, None if none is known."""
+        live = sorted(m for m, t in self.members.items() if now - t < self.lease)
+        if not live:
+            return None
+        ring = HashRing(live)
+        return {gw: ring.node(gw) for gw in self.gateways}
+
+    async def run(self, client, election, on_change):
+        """Heartbeats, assignment by the leader and ownership changes, until cancelled.
+
+        Coroutine 'on_change(added, removed)' is called with the gateways
+        gained and lost; at the start all gateways not owned are lost.
+        """
+        self.owned = None
+        leading = None  # Start of the leadership
+        while True:
+            now = time.monotonic()
+            await client.publish(self.member_topic, payload=self.instance)
+            if not election.is_leader:
+                leading = None
+            elif leading is None:
+                leading = now
+            elif now - leading >= self.lease / 3:
+                # The heartbeats of all live instances are known
+                plan = self.plan(now)
+                if plan and plan != self.assigned:
+                    await client.publish(self.topic, payload=json.dumps(plan, sort_keys=True),
+                                         retain=True)
+            owned = {gw for gw in self.gateways if self.owns(gw)}
+            if owned != self.owned:
+                was = set(self.gateways) if self.owned is None else self.owned
+                added = owned - (self.owned or set())
+                self.owned = owned
+                logger.warning(f"{self.instance}: gateways {sorted(owned)}")
+                await on_change(added, was - owned)
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), self.lease / 3)
+            except asyncio.TimeoutError:
+                pass
+
+
+class LocalBroker:
+    """In-process stand-in of an MQTT broker, for testing.
+
+    Retained messages, subscriptions with exact topics, and last wills.
+    """
+
+    def __init__(self):
+        self.retained = {}
+        self.subs = collections.defaultdict(list)  # topic -> clients
+
+    def client(self, name, will=None):
+        return LocalClient(self, name, will)
+
+    async def publish(self, topic, payload, retain):
+        payload = payload if isinstance(payload, bytes) else str(payload).encode()
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for c in list(self.subs[topic]):
+            c.deliver(topic, payload)
+        return
+
+
+class LocalClient:
+    """Client of a LocalBroker, with the publish/subscribe/messages interface."""
+
+    def __init__(self, broker, name, will=None):
+        self.broker = broker
+        self.name = name
+        self.will = will  # (topic, payload, retain)
+        self.queue = asyncio.Queue()
+        self.connected = True
+
+    def deliver(self, topic, payload):
+        self.queue.put_nowait((topic, payload))
+
+    async def publish(self, topic, payload=None, retain=False, **kwargs):
+        if self.connected:
+            await self.broker.publish(topic, payload if payload is not None else b"", retain)
+        return
+
+    async def subscribe(self, topic):
+        self.broker.subs[topic].append(self)
+        if topic in self.broker.retained:
+            self.deliver(topic, self.broker.retained[topic])
+        return
+
+    async def unsubscribe(self, topic):
+        if self in self.broker.subs[topic]:
+            self.broker.subs[topic].remove(self)
+        return
+
+    async def crash(self):
+        """Disconnect ungracefully: the broker publishes the will."""
+        self.connected = False
+        for members in self.broker.subs.values():
+            if self in members:
+                members.remove(self)
+        if self.will:
+            await self.broker.publish(*self.will)
+        return
+
+    async def messages(self):
+        while True:
+            yield await self.queue.get()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    GATEWAYS = [f"esp/gw{i}" for i in range(6)]
+
+    async def instance(broker, name, frames):
+        client = broker.client(name, will=("otgw/state", b"offline", True))
+        election = Election(name, "otgw", lease=3)
+        assignment = Assignment(name, "otgw", GATEWAYS, lease=3)
+        for t in ("otgw/leader", "otgw/state", "otgw/member", "otgw/assign"):
+            await client.subscribe(t)
+
+        async def on_change(added, removed):
+            for gw in removed:
+                await client.unsubscribe(f"{gw}/slave")
+            for gw in added:
+                await client.subscribe(f"{gw}/slave")
+
+        async def receive():
+            async for topic, payload in client.messages():
+                if topic == "otgw/leader":
+                    election.on_leader(payload)
+                elif topic == "otgw/state":
+                    await election.on_state(client, payload)
+                elif topic == "otgw/member":
+                    assignment.on_member(payload)
+                elif topic == "otgw/assign":
+                    assignment.on_assign(payload)
+                else:
+                    frames[topic].add(name)
+        tasks = (asyncio.create_task(election.run(client, grace=0.2)),
+                 asyncio.create_task(assignment.run(client, election, on_change)),
+                 asyncio.create_task(receive()))
+        return client, election, tasks
+
+    async def send(broker, frames):
+        frames.clear()
+        for gw in GATEWAYS:
+            for _ in range(5):
+                await broker.publish(f"{gw}/slave", b"40190000", False)
+        await asyncio.sleep(0.1)
+        return {t.split("/")[1]: sorted(n) for t, n in sorted(frames.items())}
+
+    async def demo():
+        broker = LocalBroker()
+        frames = collections.defaultdict(set)
+        nodes = [await instance(broker, f"node{i}", frames) for i in range(3)]
+        await asyncio.sleep(2.5)
+        print("instances per gateway", await send(broker, frames))
+        leaders = [e.instance for _, e, _ in nodes if e.is_leader]
+        print("leaders", leaders)
+        # The leader crashes
+        for c, e, tasks in nodes:
+            if e.is_leader:
+                await c.crash()
+                for t in tasks:
+                    t.cancel()
+        await asyncio.sleep(6)
+        print("leaders after crash", [e.instance for c, e, _ in nodes
+                                      if e.is_leader and c.connected])
+        print("instances per gateway", await send(broker, frames))
+        print("state", broker.retained.get("otgw/state"))
+
+    asyncio.run(demo())
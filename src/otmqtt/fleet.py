@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+"""Fleet mode: shard gateways across worker processes.
+
+Enabled with 'workers' > 0 in the [Fleet] section of the config file:
+
+  [Fleet]
+  workers = 4
+  gateways =
+      esp/mqtt_ot otgw
+      esp/ot_site2 otgw/site2
+
+Each line of 'gateways' holds the OTGW_topic of a gateway and the topic
+prefix for its decoded messages. The supervisor assigns gateways to workers
+by consistent hashing of the OTGW_topic, so adding a worker moves only a
+fraction of the gateways. Each worker has its own MQTT connection and caches,
+and its own '<topic>/worker<n>' topics for state, dump and cmd. The
+availability of the entities of a gateway is the state of its worker, with
+its last will.
+
+The supervisor restarts crashed workers, rebalances on SIGHUP after
+re-reading the config, and logs the metrics aggregated over all workers.
+"""
+import bisect
+import collections
+import hashlib
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes."""
+
+    def __init__(self, nodes, replicas=64):
+        self.ring = sorted((self.hash(f"{node}#{i}"), node)
+                           for node in nodes for i in range(replicas))
+        self.keys = [k for k, _ in self.ring]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def node(self, key):
+        """The node owning 'key'."""
+        i = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.ring[i][1]
+
+
+def parse_gateways(config):
+    """List of (OTGW_topic, topic) of all gateways in the config."""
+    gws = [tuple(line.split()) for line in config["Fleet"]["gateways"].splitlines()
+           if line.strip()]
+    if not gws:
+        gws = [(config["MQTT"]["OTGW_topic"], config["MQTT"]["topic"])]
+    return gws
+
+
+def assign(gws, workers):
+    """Assign gateways to workers: worker -> sorted list of gateways."""
+    ring = HashRing(range(workers))
+    plan = collections.defaultdict(list)
+    for gw in gws:
+        plan[ring.node(gw[0])].append(gw)
+    return {n: sorted(g) for n, g in plan.items()}
+
+
+def worker(args, n, gws, metrics):
+    """Target of a worker process."""
+    from .otmqtt import run_worker
+    return run_worker(args, n, gws, metrics)
+
+
+def supervise(args, config, read_config):
+    """Run the supervisor until interrupted."""
+    ctx = multiprocessing.get_context("spawn")
+    metrics = ctx.Queue()
+    procs = {}  # worker -> (Process, gateways)
+    restarts = collections.Counter()
+    latest = {}  # worker -> last metrics
+    reload = False
+    interval = float(config["Fleet"]["metrics_interval"])
+    last_report = time.monotonic()
+
+    def hup(signum, frame):
+        nonlocal reload
+        reload = True
+
+    def term(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGHUP, hup)
+    signal.signal(signal.SIGTERM, term)
+
+    workers = int(config["Fleet"]["workers"])
+    plan = assign(parse_gateways(config), workers)
+    logger.info(f"Fleet of {workers} workers for {sum(map(len, plan.values()))} gateways")
+    try:
+        while True:
+            if reload:
+                reload = False
+                config = read_config(args)
+                workers = int(config["Fleet"]["workers"])
+                plan = assign(parse_gateways(config), workers)
+                logger.warning(f"Rebalance over {workers} workers")
+            # Stop workers without, or with changed, gateways
+            for n, (p, gws) in list(procs.items()):
+                if plan.get(n) != gws:
+                    p.terminate()
+                    p.join()
+                    del procs[n]
+                    latest.pop(n, None)
+                elif not p.is_alive():
+                    logger.error(f"Worker {n} died with exit code {p.exitcode}, restart")
+                    restarts[n] += 1
+                    del procs[n]
+            # (Re)start workers
+            for n, gws in plan.items():
+                if n not in procs:
+                    p = ctx.Process(target=worker, args=(args, n, gws, metrics),
+                                    name=f"otmqtt-worker{n}", daemon=True)
+                    p.start()
+                    procs[n] = (p, gws)
+                    logger.info(f"Worker {n} started for {[g[0] for g in gws]}")
+            # Collect and report metrics
+            try:
+                while True:
+                    m = metrics.get(timeout=1)
+                    latest[m["worker"]] = m
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_report >= interval:
+                last_report = time.monotonic()
+                logger.warning(f"Fleet metrics: {aggregate(latest.values())}, "
+                               f"restarts {sum(restarts.values())}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p, _ in procs.values():
+            p.terminate()
+        for p, _ in procs.values():
+            p.join()
+    return 0
+
+
+def aggregate(reports):
+    """Sum the metrics of all workers."""
+    total = collections.Counter()
+    for m in reports:
+        for k, v in m.items():
+            if k == "worker":
+                total["workers"] += 1
+            elif isinstance(v, dict):
+                total.update({f"{k}.{e}": c for e, c in v.items()})
+            else:
+                total[k] += v
+    return dict(total)
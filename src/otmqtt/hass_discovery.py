@@ -1,10 +1,14 @@
 #! /usr/bin/env python3
 """ Construction of HomeAssistant discovery messages for OpenTherm.
 
-
+Either one discovery message per entity, or, with device based discovery,
+one retained message per device listing all its entities as components.
 """
+import asyncio
+import copy
 import json
 import logging
+from . import serializer
 
 logger = logging.getLogger(__name__)
 
@@ -38,22 +42,94 @@ TPL = {
     }
 }
 
+def gateway_tpl(t_esp, t_state, name=None):
+    """Template for another gateway: own availability topics and device.
+
+    't_state' is the state topic of the otmqtt process decoding the gateway,
+    with its last will. Without 'name' the device is the default one.
+    """
+    tpl = copy.deepcopy(TPL)
+    tpl["availability"][0]["topic"] = f"{t_esp}/state"
+    tpl["availability"][1]["topic"] = t_state
+    if name:
+        tpl["device"]["identifiers"] = [f"esp_otgw_{name}"]
+        tpl["device"]["name"] = f"OpenTherm Gateway {name}"
+    return tpl
+
+
 class HassDiscovery(dict):
+    # Device based discovery: node_id -> DeviceDiscovery, None if disabled
+    devices = None
 
     def __init__(self, topic, payload, TPL=TPL):
         self |= TPL
         self |= payload
         self.topic = topic
+        self.tpl = TPL
 
     def __repr__(self):
         return f"Topic:   {self.topic}\nPayload: {json.dumps(self, indent=2)}"
 
     async def publish(self, client, retain=False):
-        return await client.publish(self.topic, payload=json.dumps(self), retain=retain)
+        if self.devices is not None:
+            # Topic: <prefix>/<component>/<node_id>/<object_id>/config
+            parts = self.topic.split("/")
+            node_id = parts[-3]
+            if node_id not in self.devices:
+                self.devices[node_id] = DeviceDiscovery("/".join(parts[:-4]), node_id)
+            return self.devices[node_id].add(self, parts[-4], client)
+        return await client.publish(self.topic, payload=serializer.text_dumps(self), retain=retain)
 
     pass
 
 
+class DeviceDiscovery:
+    """One retained discovery message for all components of a device.
+
+    Published under '<prefix>/device/<node_id>/config', 'delay' seconds
+    after the last change of the set of components.
+    """
+    SHARED = ("device", "origin", "availability")
+
+    def __init__(self, prefix, node_id, delay=2.0):
+        self.topic = f"{prefix}/device/{node_id}/config"
+        self.delay = delay
+        self.shared = {}
+        self.components = {}
+        self.handle = None
+        self.published = None
+
+    def add(self, dm, component, client):
+        """Add HassDiscovery message 'dm' as 'component', publish if changed."""
+        # Shared keys from the template, keep those overridden per component
+        cmp = {k: v for k, v in dm.items() if k not in self.SHARED or v != dm.tpl.get(k)}
+        cmp["platform"] = component
+        self.shared = {k: dm.tpl[k] for k in self.SHARED if k in dm.tpl}
+        uid = cmp["unique_id"]
+        if self.components.get(uid) == cmp:
+            return
+        self.components[uid] = cmp
+        if self.handle:
+            self.handle.cancel()
+        loop = asyncio.get_running_loop()
+        self.handle = loop.call_later(
+            self.delay, lambda: asyncio.ensure_future(self.publish(client)))
+        return
+
+    def payload(self):
+        return self.shared | {"components": self.components}
+
+    async def publish(self, client):
+        self.handle = None
+        p = serializer.text_dumps(self.payload())
+        if p == self.published:
+            return
+        self.published = p
+        logger.info(f"Device discovery {self.topic} with {len(self.components)} components")
+        await client.publish(self.topic, payload=p, retain=True)
+        return
+
+
 if __name__ == "__main__":
     import pprint
     hd = HassDiscovery("has/binary_sensor/OT/config", {"unit_of_measurement": "C"})
@@ -0,0 +1,170 @@
+#! /usr/bin/env python3
+"""History of the register updates in a local SQLite database.
+
+Updates are queued by the event loop and written in batches with
+'executemany' by a writer thread, the database is in WAL mode so queries
+do not block the writer. Compact schema:
+
+  gateways(id, topic)               OTGW_topic of each gateway
+  history(ts, gw, reg, value)       ts: ms since the epoch,
+                                    reg: data_id, + 256 for the slave,
+                                    value: raw 16 bits data value
+
+Rows older than 'retention_days' are deleted hourly.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS gateways (
+    id INTEGER PRIMARY KEY,
+    topic TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    ts INTEGER NOT NULL,
+    gw INTEGER NOT NULL,
+    reg INTEGER NOT NULL,
+    value INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_ts ON history (ts);
+CREATE INDEX IF NOT EXISTS history_reg_ts ON history (gw, reg, ts);
+"""
+
+MS = {"m": 0, "s": 256}  # Offset of master/slave registers
+
+
+def connect(path):
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class HistoryStore:
+    """Batched writer and query API of the register history in 'path'."""
+
+    def __init__(self, path, retention_days=30.0, batch=500, interval=1.0):
+        self.path = path
+        self.retention = retention_days * 86400 * 1000
+        self.batch = batch
+        self.interval = interval
+        self.queue = queue.SimpleQueue()
+        self.written = 0
+        db = connect(path)
+        db.executescript(SCHEMA)
+        self.gw_ids = dict(db.execute("SELECT topic, id FROM gateways"))
+        db.close()
+        self.reader = None
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.writer, name="otmqtt-history", daemon=True)
+        self.thread.start()
+
+    def add(self, gateway, ms, reg, value, ts=None):
+        """Queue update 'value' of register 'reg' of master/slave 'ms'."""
+        self.queue.put((time.time() * 1000 if ts is None else ts, gateway, MS[ms] + reg, value))
+        return
+
+    def close(self):
+        """Write the queued updates and stop the writer."""
+        self.queue.put(None)
+        self.thread.join()
+        return
+
+    def writer(self):
+        db = connect(self.path)
+        purged = 0.0
+        stop = False
+        while not stop:
+            rows = []
+            try:
+                item = self.queue.get(timeout=self.interval)
+                while item is not None:
+                    rows.append(item)
+                    if len(rows) >= self.batch:
+                        break
+                    item = self.queue.get_nowait()
+                stop = item is None
+            except queue.Empty:
+                pass
+            try:
+                if rows:
+                    db.executemany("INSERT INTO history VALUES (?, ?, ?, ?)",
+                                   [(int(ts), self.gw_id(db, gw), reg, value)
+                                    for ts, gw, reg, value in rows])
+                    db.commit()
+                    self.written += len(rows)
+                now = time.time()
+                if self.retention and now - purged > 3600:
+                    purged = now
+                    db.execute("DELETE FROM history WHERE ts < ?",
+                               (int(now * 1000 - self.retention),))
+                    db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"History: {e}, {len(rows)} updates lost")
+        db.close()
+        return
+
+    def gw_id(self, db, topic):
+        gid = self.gw_ids.get(topic)
+        if gid is None:
+            db.execute("INSERT OR IGNORE INTO gateways (topic) VALUES (?)", (topic,))
+            gid = self.gw_ids[topic] = db.execute(
+                "SELECT id FROM gateways WHERE topic = ?", (topic,)).fetchone()[0]
+        return gid
+
+    def query(self, gateway=None, ms=None, reg=None, start=None, end=None, limit=1000):
+        """Updates as list of (ts, gateway, ms, reg, value), the latest first.
+
+        Filter on 'gateway' (OTGW_topic), 'ms', 'reg' (data_id) and time
+        range [start, end) in ms since the epoch. Blocking, run it in an
+        executor from the event loop.
+        """
+        where, params = [], []
+        if gateway is not None:
+            where.append("g.topic = ?")
+            params.append(gateway)
+        if reg is not None:
+            regs = [MS[m] + reg for m in (ms or "ms")]
+            where.append(f"h.reg IN ({', '.join('?' * len(regs))})")
+            params += regs
+        elif ms is not None and len(ms) == 1:
+            where.append("h.reg / 256 = ?")
+            params.append(MS[ms] // 256)
+        if start is not None:
+            where.append("h.ts >= ?")
+            params.append(int(start))
+        if end is not None:
+            where.append("h.ts < ?")
+            params.append(int(end))
+        sql = ("SELECT h.ts, g.topic, h.reg, h.value FROM history h "
+               "JOIN gateways g ON g.id = h.gw")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY h.ts DESC LIMIT ?"
+        params.append(int(limit))
+        with self.lock:
+            if self.reader is None:
+                self.reader = connect(self.path)
+            rows = self.reader.execute(sql, params).fetchall()
+        return [(ts, gw, "ms"[r >> 8], r & 0xff, v) for ts, gw, r, v in rows]
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "written": self.written}
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "history.db")
+    h = HistoryStore(path)
+    t0 = time.perf_counter()
+    for i in range(100000):
+        h.add("esp/mqtt_ot", "ms"[i & 1], i % 30, i & 0xffff)
+    h.close()
+    print(f"{h.written} updates in {time.perf_counter() - t0:.2f}s")
+    print(h.query(reg=25, ms="s", limit=3))
@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+"""End-to-end latency tracking per register.
+
+Two latencies are tracked for each register:
+- transport:  from the origin timestamp of the frame, set by the gateway in
+              MQTT v5 user property 'ts' or in a batch, until arrival in
+              otmqtt (ESP -> broker -> otmqtt)
+- processing: from arrival until the state message is published by otmqtt
+
+Both are kept in fixed-size histograms with power-of-2 buckets in µs.
+All timestamps are wall clock in ms since the epoch.
+"""
+import time
+
+# User property with the origin timestamp (ms since the epoch)
+TS_PROPERTY = "ts"
+
+
+def now_ms():
+    return time.time() * 1000.0
+
+
+def origin_timestamp(message):
+    """Origin timestamp from the MQTT v5 user properties of message, or None."""
+    props = getattr(message, "properties", None)
+    for k, v in getattr(props, "UserProperty", None) or ():
+        if k == TS_PROPERTY:
+            try:
+                return float(v)
+            except ValueError:
+                return None
+    return None
+
+
+def publish_properties(ts):
+    """MQTT v5 publish properties carrying origin timestamp 'ts'."""
+    from paho.mqtt.packettypes import PacketTypes
+    from paho.mqtt.properties import Properties
+    props = Properties(PacketTypes.PUBLISH)
+    props.UserProperty = [(TS_PROPERTY, f"{ts:.0f}")]
+    return props
+
+
+class Histogram:
+    """Histogram of latencies, bucket i counts [2**(i-1), 2**i) µs."""
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        us = max(0, int(ms * 1000.0))
+        self.counts[min(us.bit_length(), self.BUCKETS - 1)] += 1
+        self.n += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        return
+
+    def percentile(self, q):
+        """Upper bound in ms of the bucket holding percentile 'q' (0-100)."""
+        if not self.n:
+            return None
+        rank = q / 100.0 * self.n
+        cum = 0
+        for i, c in enumerate(self.counts):
+            cum += c
+            if cum >= rank and c:
+                return min((1 << i) / 1000.0, round(self.max, 3))
+        return self.max
+
+    def report(self):
+        if not self.n:
+            return {"n": 0}
+        return {
+            "n": self.n,
+            "mean": round(self.total / self.n, 3),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": round(self.max, 3),
+        }
+
+
+class LatencyTracker:
+    """Latency histograms per (register, kind)."""
+
+    def __init__(self):
+        self.hists = {}
+
+    def add(self, reg, kind, ms):
+        h = self.hists.get((reg, kind))
+        if h is None:
+            h = self.hists[(reg, kind)] = Histogram()
+        h.add(ms)
+        return
+
+    def transport(self, reg, origin, arrival):
+        self.add(reg, "transport", arrival - origin)
+        return
+
+    def processing(self, reg, arrival, published):
+        self.add(reg, "processing", published - arrival)
+        return
+
+    def report(self):
+        """Nested dict: register -> kind -> statistics."""
+        r = {}
+        for (reg, kind), h in sorted(self.hists.items()):
+            r.setdefault(reg, {})[kind] = h.report()
+        return r
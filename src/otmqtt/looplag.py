@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+"""Event-loop lag monitor and slow-handler detector.
+
+A coroutine sleeps 'interval' seconds in a loop; the lag is how much later
+than requested it wakes up. The lags are kept in a histogram (percentiles)
+and every lag over 'threshold' is recorded with the task handler running
+at the time, see 'handling'.
+
+While the loop is blocked the coroutine cannot run, so a watchdog thread
+takes a stack sample of the loop thread as soon as the lag exceeds the
+threshold: it shows what blocks the loop, not only which handler.
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import sys
+import threading
+import time
+import traceback
+from .latency import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """Lag of the running event loop, measured every 'interval' seconds."""
+
+    def __init__(self, interval=0.1, threshold=0.1, keep=16):
+        self.interval = interval
+        self.threshold = threshold
+        self.hist = Histogram()
+        self.slow = collections.deque(maxlen=keep)  # Last slow events
+        self.stalls = 0
+        self.handler = None  # Name of the running task handler
+        self.deadline = None  # Expected wake-up, time.monotonic()
+        self.sample = None  # (handler, stack) taken by the watchdog
+        self.thread_id = None
+
+    @contextlib.contextmanager
+    def handling(self, name):
+        """Context of task handler 'name'."""
+        self.handler = name
+        try:
+            yield
+        finally:
+            self.handler = None
+
+    def watchdog(self):
+        """Thread: sample the stack of the loop thread when it is blocked."""
+        while True:
+            time.sleep(self.threshold / 2)
+            deadline = self.deadline
+            if deadline is None or self.sample is not None:
+                continue
+            if time.monotonic() > deadline + self.threshold:
+                frame = sys._current_frames().get(self.thread_id)
+                stack = [f"{f.filename}:{f.lineno} {f.name}"
+                         for f in traceback.extract_stack(frame)] if frame else []
+                self.sample = (self.handler, stack[-12:])
+
+    async def run(self):
+        """Measure the lag until cancelled."""
+        self.thread_id = threading.get_ident()
+        threading.Thread(target=self.watchdog, name="otmqtt-looplag", daemon=True).start()
+        while True:
+            self.deadline = time.monotonic() + self.interval
+            handler = self.handler
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self.deadline
+            self.hist.add(lag * 1000.0)
+            if lag > self.threshold:
+                self.stalls += 1
+                sample = self.sample or (self.handler or handler, [])
+                self.slow.append({
+                    "time": round(time.time(), 3),
+                    "lag_ms": round(lag * 1000.0, 1),
+                    "handler": sample[0],
+                    "stack": sample[1],
+                })
+                logger.warning(f"Event loop blocked {lag * 1000.0:.0f} ms in {sample[0]}")
+            self.sample = None
+
+    def report(self):
+        return {
+            "lag_ms": self.hist.report(),
+            "stalls": self.stalls,
+            "slow": list(self.slow),
+        }
+
+
+if __name__ == "__main__":
+    import json
+
+    def blocking():
+        time.sleep(0.3)
+
+    async def demo():
+        monitor = LoopMonitor(interval=0.05, threshold=0.1)
+        task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0.2)
+        with monitor.handling("process_dump_state"):
+            blocking()
+            await asyncio.sleep(0.1)
+        task.cancel()
+        print(json.dumps(monitor.report(), indent=2))
+
+    asyncio.run(demo())
@@ -0,0 +1,81 @@
+#! /usr/bin/env python3
+"""Memory accounting for long running daemons.
+
+Samples periodically:
+- RSS of the process
+- tracemalloc current and peak, when tracing is enabled
+- the (deep) size of each subsystem, e.g. register table, caches, queues
+
+Sizes of subsystems are approximations: the sum of sys.getsizeof of all
+objects reachable through containers, each object counted once.
+"""
+import array
+import collections
+import os
+import sys
+import tracemalloc
+
+CONTAINERS = (dict, list, tuple, set, frozenset, collections.deque)
+
+
+def rss_bytes():
+    """Resident set size of this process, None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # Peak RSS, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+def deep_sizeof(obj, seen=None):
+    """Approximate size of 'obj' and all objects in it."""
+    if seen is None:
+        seen = set()
+    size = 0
+    todo = [obj]
+    while todo:
+        o = todo.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            todo.extend(o.keys())
+            todo.extend(o.values())
+        elif isinstance(o, CONTAINERS):
+            todo.extend(o)
+        elif isinstance(o, array.array):
+            pass
+        elif hasattr(o, "__dict__"):
+            todo.append(o.__dict__)
+    return size
+
+
+def start_tracing(frames):
+    """Start tracemalloc with 'frames' frames per trace, 0: off."""
+    if frames and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    return
+
+
+def sample(subsystems, top=0):
+    """Memory report, subsystems: name -> object(s) to account."""
+    report = {"rss": rss_bytes()}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report["tracemalloc"] = {"current": current, "peak": peak}
+        if top:
+            stats = tracemalloc.take_snapshot().statistics("lineno")[:top]
+            report["tracemalloc"]["top"] = [
+                {"where": str(s.traceback), "size": s.size, "count": s.count}
+                for s in stats]
+    seen = set()
+    report["subsystems"] = {name: deep_sizeof(objs, seen)
+                            for name, objs in subsystems.items()}
+    return report
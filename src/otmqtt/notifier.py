@@ -0,0 +1,232 @@
+#! /usr/bin/env python3
+"""Asynchronous notifications, e.g. gateway state changes and boiler faults.
+
+'notify' only appends to a bounded queue, it never blocks the caller. The
+notifier task:
+- merges a burst of notifications within 'burst' seconds into one message
+- sends at most 'rate' messages per second
+- retries a failed send with exponential backoff, up to 'retries' times
+The oldest notifications are dropped when the queue is full.
+
+Targets are pluggable: Telegram, a JSON webhook, or the log. The HTTP
+targets keep one persistent connection, used by their own thread since
+http.client is blocking.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import http.client
+import json
+import logging
+import random
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+
+class NotifyError(Exception):
+    pass
+
+
+class LogTarget:
+    """Notifications in the log."""
+
+    async def send(self, text):
+        logger.warning(f"Notification: {text}")
+        return
+
+
+class HttpTarget:
+    """POST of a JSON body to 'url' over a persistent connection."""
+
+    def __init__(self, url, timeout=10.0):
+        self.url = urllib.parse.urlsplit(url)
+        self.timeout = timeout
+        self.conn = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="otmqtt-notify")
+
+    def body(self, text):
+        return {"text": text}
+
+    def post(self, body):
+        """Blocking, in the executor thread. Any failure is a NotifyError."""
+        path = self.url.path or "/"
+        if self.url.query:
+            path += f"?{self.url.query}"
+        try:
+            if self.conn is None:
+                cls = (http.client.HTTPSConnection if self.url.scheme == "https"
+                       else http.client.HTTPConnection)
+                self.conn = cls(self.url.netloc, timeout=self.timeout)
+            self.conn.request("POST", path, body=json.dumps(body).encode("utf-8"),
+                              headers={"Content-Type": "application/json"})
+            resp = self.conn.getresponse()
+            resp.read()
+        except Exception as e:
+            if self.conn:
+                self.conn.close()
+            self.conn = None
+            raise NotifyError(f"{self.url.netloc}: {e}") from e
+        if resp.status >= 300:
+            raise NotifyError(f"{self.url.netloc}: HTTP {resp.status} {resp.reason}")
+        return
+
+    async def send(self, text):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.post, self.body(text))
+        return
+
+
+class WebhookTarget(HttpTarget):
+    """JSON webhook, body {"text": <message>}."""
+    pass
+
+
+class TelegramTarget(HttpTarget):
+    """Telegram bot 'token', messages to 'chat_id'."""
+
+    def __init__(self, token, chat_id, timeout=10.0):
+        super().__init__(f"https://api.telegram.org/bot{token}/sendMessage", timeout)
+        self.chat_id = chat_id
+
+    def body(self, text):
+        return {"chat_id": self.chat_id, "text": text}
+
+
+class Notifier:
+    """Bounded, rate limited and merging queue of notifications to 'targets'."""
+
+    def __init__(self, targets, maxsize=100, rate=0.2, burst=5.0, retries=5,
+                 backoff=1.0, max_backoff=60.0, max_lines=20):
+        self.targets = targets
+        self.queue = collections.deque(maxlen=maxsize)
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_lines = max_lines
+        self.event = None
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def notify(self, text):
+        """Queue notification 'text', never blocks."""
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(text)
+        if self.event:
+            self.event.set()
+        return
+
+    def merge(self):
+        """All queued notifications as one message."""
+        lines = list(self.queue)
+        self.queue.clear()
+        if len(lines) > self.max_lines:
+            lines = lines[:self.max_lines] + [f"... and {len(lines) - self.max_lines} more"]
+        return "\n".join(lines)
+
+    async def deliver(self, target, text):
+        for trial in range(self.retries + 1):
+            try:
+                await target.send(text)
+                return True
+            except NotifyError as e:
+                delay = min(self.max_backoff, self.backoff * 2 ** trial)
+                delay *= random.uniform(0.5, 1.0)
+                logger.warning(f"Notification failed: {e}, retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        self.failed += 1
+        logger.error(f"Notification dropped after {self.retries} retries: {text}")
+        return False
+
+    async def run(self):
+        """Send the queued notifications until cancelled."""
+        self.event = asyncio.Event()
+        last = float("-inf")
+        while True:
+            if not self.queue:
+                self.event.clear()
+                await self.event.wait()
+            # Collect the burst
+            await asyncio.sleep(self.burst)
+            # Rate limit
+            wait = last + 1.0 / self.rate - time.monotonic() if self.rate else 0
+            if wait > 0:
+                await asyncio.sleep(wait)
+            text = self.merge()
+            last = time.monotonic()
+            results = await asyncio.gather(*(self.deliver(t, text) for t in self.targets),
+                                           return_exceptions=True)
+            for e in results:
+                if isinstance(e, Exception):
+                    # A bug in a target must not stop the notifier
+                    self.failed += 1
+                    logger.error(f"Notification failed: {e!r}")
+            self.sent += 1
+
+    def stats(self):
+        return {"queued": len(self.queue), "sent": self.sent,
+                "dropped": self.dropped, "failed": self.failed}
+
+
+class WebhookStandIn:
+    """Local webhook server, for testing: collects the received bodies.
+
+    The first 'fail' requests are answered with HTTP 503.
+    """
+
+    def __init__(self, fail=0):
+        import http.server
+        import threading
+        stand_in = self
+        self.received = []
+        self.fail = fail
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if stand_in.fail > 0:
+                    stand_in.fail -= 1
+                    self.send_response(503)
+                else:
+                    stand_in.received.append(json.loads(body))
+                    self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/hook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    async def demo():
+        hook = WebhookStandIn(fail=2)
+        notifier = Notifier([WebhookTarget(hook.url), LogTarget()],
+                            rate=10, burst=0.2, backoff=0.1)
+        task = asyncio.create_task(notifier.run())
+        for i in range(5):
+            notifier.notify(f"Boiler fault {i}")
+        await asyncio.sleep(1.5)
+        notifier.notify("Gateway esp/mqtt_ot: online")
+        await asyncio.sleep(0.5)
+        task.cancel()
+        print(hook.received, notifier.stats())
+        hook.close()
+
+    asyncio.run(demo())
@@ -18,13 +18,22 @@ NOTES:  Given my setting with Lyric T6 and Intergas <type>
 
 """
 import copy
-import json
 import logging
 import sys
-from .hass_discovery import HassDiscovery
+from . import serializer
+from .hass_discovery import TPL, HassDiscovery
 
 logger = logging.getLogger(__name__)
 
+# Parity of each byte value
+PARITY = bytes(bin(i).count("1") & 1 for i in range(256))
+
+
+def parity(frame):
+    """Parity of a 32 bits frame using the byte parity table."""
+    return (PARITY[frame & 0xff] ^ PARITY[(frame >> 8) & 0xff] ^
+            PARITY[(frame >> 16) & 0xff] ^ PARITY[(frame >> 24) & 0xff])
+
 
 class OpenThermProtocol:
     """OpenTherm Datalink layer protocol.
@@ -52,6 +61,10 @@ class OpenThermProtocol:
         "ui"
     ]
 
+    # Message types carrying data, and error replies, per direction
+    data_msg_types = {"m": (0, 1), "s": (4, 5)}
+    error_msg_types = {"m": (2,), "s": (6, 7)}
+
     device_class = {
         "°C": "temperature",
         "%": "number",
@@ -70,19 +83,27 @@ class OpenThermProtocol:
         return
 
     def _parity(self):
-        """ Check parity.
+        """ Check parity, 1 if the number of ones in the frame is odd."""
+        return parity(self.frame)
+
+    @classmethod
+    def validate(cls, frame, ms):
+        """Validate a raw frame from master ("m") or slave ("s").
 
-        See: https://www.geeksforgeeks.org/finding-the-parity-of-a-number-efficiently/
+        Return None for a valid data frame, else the kind of error:
+        "parity", "spare", "msg_type" (reserved or wrong direction),
+        "invalid_data" (Invalid-Data, Data-Invalid) or "unknown_id".
         """
-        y = self.frame ^ (self.frame >> 1);
-        y = y ^ (y >> 2);
-        y = y ^ (y >> 4);
-        y = y ^ (y >> 8);
-        y = y ^ (y >> 16);
-        # Rightmost bit of y holds the parity value if (y&1) is 1
-        # then parity is odd
-        # else even
-        return (y & 1)
+        if parity(frame):
+            return "parity"
+        if frame & 0x0f000000:
+            return "spare"
+        t = (frame >> 28) & 0x7
+        if t in cls.data_msg_types[ms]:
+            return None
+        if t in cls.error_msg_types[ms]:
+            return "unknown_id" if t == 7 else "invalid_data"
+        return "msg_type"
 
     def msg_type(self):
         assert self.b_msg_type not in [2, 3, 6, 7], "Error or invalid data in message."
@@ -103,6 +124,32 @@ class OpenThermApplProtocol(OpenThermProtocol):
 
     Typically initialized using the 'from_frame' factory function.
     """
+    # Publish flags to their own topic, only when changed (bit-diff)
+    flag_topics = False
+    # Flag groups in OT for this register, e.g. ("hflags", "lflags")
+    flag_groups = ()
+    # The whole value consists of flags
+    flags_only = False
+    # Discovery of the gateway, overridden per frame for other gateways
+    t_ot = "otgw"
+    node_id = "OpenThermGW"
+    uid_prefix = "esp8266_otgw_b4e62d1428ea"
+    tpl = TPL
+    # Registers with per-entity availability on '<t_ot>/<reg>/<ms>_available'
+    # (staleness)
+    entity_availability = frozenset()
+    # Serialized object payloads per (data_id, data_value), values repeat on
+    # the bus; cleared with 'clear_payloads' when the register table changes
+    payloads = {}
+    payloads_max = 4096
+
+    @staticmethod
+    def subclass(name):
+        """The SubClass with 'name', None if not existing."""
+        cls = globals().get(name)
+        if isinstance(cls, type) and issubclass(cls, OpenThermApplProtocol):
+            return cls
+        return None
 
     @staticmethod
     def from_frame(frame):
@@ -132,9 +179,40 @@ class OpenThermApplProtocol(OpenThermProtocol):
         flgs = {f"{v[0]}": int(v[1]) for v in zip(flags, bits[0:8])}
         return flgs
 
-    def decode_payload(self):
+    def decode_value(self):
+        """Decoded value: a number, string or dict of sub-values."""
         return self.b_data_value
 
+    def decode_payload(self):
+        """Payload of the decoded value, dicts are serialized.
+
+        Serialized dicts are cached, so a repeated value is not decoded again.
+        """
+        key = (self.b_data_id, self.b_data_value)
+        p = self.payloads.get(key)
+        if p is not None:
+            return p
+        v = self.decode_value()
+        if not isinstance(v, dict):
+            return v
+        if len(self.payloads) >= self.payloads_max:
+            self.payloads.clear()
+        p = self.payloads[key] = serializer.dumps(v)
+        return p
+
+    @staticmethod
+    def clear_payloads():
+        """Forget the cached payloads, after a change of register table or encoder."""
+        OpenThermApplProtocol.payloads.clear()
+        return
+
+    @staticmethod
+    def value_template(key):
+        """Discovery template for 'key' of an object payload, None if binary."""
+        if serializer.binary:
+            return None
+        return "{{ value_json." + key + " }}"
+
     def mqtt_msg(self, ms):
         """Construct topic and payload with message type."""
         # t = str(self.b_data_id) + "/" + self.shrt_msg_types[self.b_msg_type]
@@ -142,12 +220,45 @@ class OpenThermApplProtocol(OpenThermProtocol):
         p = self.decode_payload()
         return t, p
 
+    def mqtt_flags(self, ms, old=None):
+        """Construct topics and payloads of the enabled flags changed w.r.t. 'old'.
+
+        The changed bits are the XOR of the new and the old data value,
+        without old value all enabled flags are returned.
+        Bit numbering follows 'flags_payload'.
+        """
+        r = self.b_data_id
+        v = self.b_data_value
+        changed = 0xffff if old is None else v ^ old
+        t = f"{r}/{ms}_{self.shrt_msg_types[self.b_msg_type]}"
+        msgs = []
+        for group in self.flag_groups:
+            for i, (select, flag) in enumerate(zip(self.OT[r][f"{group}_enabled"],
+                                                   self.OT[r][group])):
+                if select and (changed >> i) & 1:
+                    msgs.append((f"{t}/{flag}", (v >> i) & 1))
+        return msgs
+
+    def mqtt_msgs(self, ms, old=None):
+        """Construct all (topic, payload, retain) state messages.
+
+        With 'flag_topics' the flags are published as retained per-flag
+        topics, only when changed.
+        """
+        msgs = []
+        if self.flag_topics and self.flag_groups:
+            msgs = [(t, p, True) for t, p in self.mqtt_flags(ms, old)]
+            if self.flags_only:
+                return msgs
+        t, p = self.mqtt_msg(ms)
+        return msgs + [(t, p, False)]
+
     def mqtt_desc(self):
         """Construct topic and payload for description of register."""
         t = str(self.b_data_id) + "/desc"
         p = self.OT[self.b_data_id]["Description"]
         if type(p) == list:
-            p = json.dumps(p)
+            p = serializer.text_dumps(p)
         return t, p
 
     def mqtt_rw(self):
@@ -161,14 +272,15 @@ class OpenThermApplProtocol(OpenThermProtocol):
         t = str(self.b_data_id) + "/d_obj"
         p = self.OT[self.b_data_id]["DataObject"]
         if type(p) == list:
-            p = json.dumps(p)
+            p = serializer.text_dumps(p)
         return t, p
 
-    def discovery_topic(self, ms, component="sensor", node_id="OpenThermGW", topic_ext="", topic={}):
+    def discovery_topic(self, ms, component="sensor", node_id=None, topic_ext="", topic={}):
         """Construct the MQTT discovery topic.
         
         """
         reg_id = self.b_data_id
+        node_id = node_id or self.node_id
 
         if "DataObject" in topic:
             config_id = topic["DataObject"]
@@ -190,17 +302,24 @@ class OpenThermApplProtocol(OpenThermProtocol):
         p = {} if not hasattr(self, "dis_payload") else copy.deepcopy(self.dis_payload)
 
         p["name"] = self.OT[reg_id]["Description"]
-        p["state_topic"] = f"otgw/{reg_id}/{ms}_{self.shrt_msg_types[self.b_msg_type]}"
+        p["state_topic"] = f"{self.t_ot}/{reg_id}/{ms}_{self.shrt_msg_types[self.b_msg_type]}"
         if "DataObject" in topic:
             dobj = topic["DataObject"]
         else:
             dobj = self.OT[reg_id]['DataObject']
-        uid = f"esp8266_otgw_b4e62d1428ea_{reg_id}_{dobj}"
+        uid = f"{self.uid_prefix}_{reg_id}_{dobj}"
         if uid_ext:
             dobj += f"_{uid_ext}"
             uid += f"_{uid_ext}"
         p["object_id"] = dobj + f"_{ms}"
         p["unique_id"] = uid + f"_{ms}"
+        if reg_id in self.entity_availability:
+            p["availability"] = self.tpl["availability"] + [{
+                "topic": f"{self.t_ot}/{reg_id}/{ms}_available",
+                "payload_available": "online",
+                "payload_not_available": "offline"
+            }]
+            p["availability_mode"] = "all"
 
         return p
 
@@ -229,10 +348,15 @@ class OpenThermApplProtocol(OpenThermProtocol):
         p = self.discovery_payload(ms, uid_ext=flag, topic=topic)
         p["name"] = f"Status {flag}"
         p["device_class"] = devclass
-        p["value_template"] = "{{ value_json." + flag + " }}"
+        if self.flag_topics:
+            p["state_topic"] += f"/{flag}"
+        elif self.value_template(flag):
+            p["value_template"] = self.value_template(flag)
+        else:
+            return
         p["payload_off"] = "0"
         p["payload_on"]  = "1"
-        dm = HassDiscovery(t, p)
+        dm = HassDiscovery(t, p, TPL=self.tpl)
         await dm.publish(client)
         return
 
@@ -247,17 +371,19 @@ class OpenThermApplProtocol(OpenThermProtocol):
         p = self.discovery_payload(ms, topic=topic)
         p |= payload
 
-        dm = HassDiscovery(t, p)
+        dm = HassDiscovery(t, p, TPL=self.tpl)
         await dm.publish(client)
         return
 
 
 class OT_f8f8(OpenThermApplProtocol):
+    flag_groups = ("hflags", "lflags")
+    flags_only = True
 
-    def decode_payload(self):
+    def decode_value(self):
         hf = self.flags_payload(self.OT[self.b_data_id]["hflags"])
         lf = self.flags_payload(self.OT[self.b_data_id]["lflags"])
-        return json.dumps(hf | lf)
+        return hf | lf
 
     async def mqtt_discovery(self, client, ms):
         """Generate binary_sensors."""
@@ -296,7 +422,7 @@ class OT_f8f8(OpenThermApplProtocol):
 #         m = {f"{v[0]}": int(v[1]) for v in zip(self.master_flags, bits[8:])}
 #         return json.dumps(m | s)
 
-#     def decode_payload(self):
+#     def decode_value(self):
 #         return self.flags_payload()
 
 #     async def mqtt_discovery(self, client, ms):
@@ -337,12 +463,13 @@ class OT_f8f8(OpenThermApplProtocol):
 
 
 class OT_f8u8(OpenThermApplProtocol):
+    flag_groups = ("hflags",)
 
-    def decode_payload(self):
+    def decode_value(self):
         hf = self.flags_payload(self.OT[self.b_data_id]["hflags"])        
         r = self.b_data_id
         v = {self.OT[r]["DataObject"][1]: self.b_data_value & 0xff}
-        return json.dumps(hf | v)
+        return hf | v
 
     async def mqtt_discovery(self, client, ms):
         r = self.b_data_id
@@ -354,30 +481,34 @@ class OT_f8u8(OpenThermApplProtocol):
             await self.mqtt_discovery_flag(client, ms, select, flag, devclass, topic=t)
         # Add u8 value
         dobj = self.OT[r]["DataObject"][1]
+        if not self.value_template(dobj):
+            return
         t = {"DataObject": dobj}
         p = {"name": self.OT[r]["Description"][1]}
-        p["value_template"] = "{{ " + f"value_json.{dobj}" + " }}"
+        p["value_template"] = self.value_template(dobj)
         await super().mqtt_discovery(client, ms, payload=p, topic=t)
         return
 
 
 class OT_reg_100(OpenThermApplProtocol):
+    flag_groups = ("lflags",)
 
-    def decode_payload(self):
+    def decode_value(self):
         r = self.b_data_id
         dv = self.b_data_value
         v = {self.OT[r]["DataObject"][0]: (dv >> 8) & 0xff}
         lf = self.flags_payload(self.OT[self.b_data_id]["lflags"])
-        return json.dumps(v | lf)
+        return v | lf
 
     async def mqtt_discovery(self, client, ms):
         r = self.b_data_id
         # Add u8 value
         dobj = self.OT[r]["DataObject"][0]
-        t = {"DataObject": dobj}
-        p = {"name": self.OT[r]["Description"][0]}
-        p["value_template"] = "{{ " + f"value_json.{dobj}" + " }}"
-        await super().mqtt_discovery(client, ms, payload=p, topic=t)
+        if self.value_template(dobj):
+            t = {"DataObject": dobj}
+            p = {"name": self.OT[r]["Description"][0]}
+            p["value_template"] = self.value_template(dobj)
+            await super().mqtt_discovery(client, ms, payload=p, topic=t)
         # Add flags
         t = {"DataObject": self.OT[r]["DataObject"][1]}
         for select, flag, devclass in zip(self.OT[r]['lflags_enabled'],
@@ -393,14 +524,16 @@ class OT_u8u8_dual(OpenThermApplProtocol):
         "device_class": ["enum", "enum"]
     }
 
-    def decode_payload(self):
+    def decode_value(self):
         r = self.b_data_id
         dv = self.b_data_value
         v = {self.OT[r]["DataObject"][0]: (dv >> 8) & 0xff,
              self.OT[r]["DataObject"][1]: dv & 0xff}
-        return json.dumps(v)
+        return v
 
     async def mqtt_discovery(self, client, ms):
+        if serializer.binary:
+            return
         try:
             for i, (do, ds, unit, devc) in enumerate(
                     zip(self.OT[self.b_data_id]["DataObject"],
@@ -411,7 +544,7 @@ class OT_u8u8_dual(OpenThermApplProtocol):
                 p = {"name": ds}
                 p["unit_of_measurement"] = unit
                 p["device_class"] = devc
-                p["value_template"] = "{{ " + f"value_json.{do}" + " }}"
+                p["value_template"] = self.value_template(do)
                 await super().mqtt_discovery(client, ms, p, t)
         except TypeError as e:
             logger.error(f"{e}\nFailure with register {self.b_data_id}")
@@ -426,7 +559,7 @@ class OT_reg_15(OT_u8u8_dual):
 
 class OT_s8s8_dual(OT_u8u8_dual):
 
-    def decode_payload(self):
+    def decode_value(self):
 
         def sbyte(v):
             return (v - 0x100) if v & 0x80 else v
@@ -435,7 +568,7 @@ class OT_s8s8_dual(OT_u8u8_dual):
         dv = self.b_data_value
         v = {self.OT[r]["DataObject"][0]: sbyte((dv >> 8) & 0xff),
              self.OT[r]["DataObject"][1]: sbyte(dv & 0xff)}
-        return json.dumps(v)
+        return v
 
 
 class OT_s8s8_dual_C(OT_s8s8_dual):
@@ -447,7 +580,7 @@ class OT_s8s8_dual_C(OT_s8s8_dual):
 
 class OT_reg_20(OpenThermApplProtocol):
 
-    def decode_payload(self):
+    def decode_value(self):
         v = self.b_data_value
         return f"[{(v >> 13) & 0x7},{(v >> 8) & 0x1f},{v & 0xff}]"
 
@@ -459,7 +592,7 @@ class OT_reg_20(OpenThermApplProtocol):
 
 class OT_f88(OpenThermApplProtocol):
 
-    def decode_payload(self):
+    def decode_value(self):
         v = self.b_data_value
         t = (v - 0x10000) / 256.0 if v & 0x8000 else v / 256.0
         return f"{t:.2f}"
@@ -503,7 +636,7 @@ class OT_reg_33(OpenThermApplProtocol):
         "device_class": "temperature"
     }
 
-    def decode_payload(self):
+    def decode_value(self):
         v = self.b_data_value
         return (v - 0x10000) if v & 0x8000 else v
 
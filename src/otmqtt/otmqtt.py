@@ -5,24 +5,45 @@
 """
 import argparse
 import asyncio
+import collections
 import configparser
 import copy
 import datetime
+import functools
 import logging
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import aiomqtt
 from io import StringIO
 import json
 import os
+import random
 import re
-import requests
+import signal
 import socket
 import struct
 import sys
+import sqlite3
 import ssl
+import time
 import traceback
+from . import memstats
+from .client import Client
+from .cluster import Assignment, Election
+from .fleet import parse_gateways
+from . import serializer
+from .hass_discovery import HassDiscovery, gateway_tpl
+from .history import HistoryStore
+from .looplag import LoopMonitor
+from .latency import LatencyTracker, now_ms, origin_timestamp, publish_properties
+from .notifier import LogTarget, Notifier, TelegramTarget, WebhookTarget
 from .opentherm import OpenThermApplProtocol
 from .ot_registers import OT
+from .profiler import Profiler
+from .publish_queue import PacedPublisher, PublishQueue
+from .rules import RuleEngine
+from .staleness import StalenessTracker
 
 from otmqtt import __version__
 
@@ -33,34 +54,189 @@ __license__ = "mit"
 
 args = None  # Commandline arguments
 
-telegram = None  # Telegram bot
+notifier = None  # Notifications, see make_notifier
 
 online = False
 
-# Message Cache
-msgs_master = {}
-msgs_slave = {}
+# Gateways: OTGW_topic -> Gateway
+gateways = {}
 
-t_esp = None
+ms_descs = {"m": "Master", "s": "Slave "}
+
+# Batched frames, binary format
+BATCH_MAGIC = b"OTB1"
+BATCH_HEADER = struct.Struct(">4sQ")
+BATCH_RECORD = struct.Struct(">BIH")
+
+# Maximum number of history rows and of items per page of a query answer
+QUERY_LIMIT = 10000
+QUERY_PAGE_SIZE = 500
+
+# Frame validation: error counters and last rejected frames
+frame_errors = collections.Counter()
+quarantine = collections.deque(maxlen=32)
+
+# Coalescing publish queue, handed to the task handlers as 'client'
+queue = None
+
+# Latency histograms per register
+latency = LatencyTracker()
+
+# Event-loop lag and slow handlers
+loop_monitor = LoopMonitor()
+
+# Register table as built-in, before loading 'registers' file
+OT_builtin = copy.deepcopy(OT)
+
+# Running rediscovery task
+rediscovery = None
+
+# Staleness of the registers per gateway, None if disabled
+staleness = None
+
+# History of the register updates in SQLite, None if disabled
+history = None
+
+# Leader election of the cluster, None if not clustered
+election = None
+
+# Gateways assigned to the instances of the cluster, None if not clustered
+assignment = None
+
+# Alert rules, None if there are none
+rules = None
 
 logger = None
 
 
-class Telegram:
-    """Booy12 bot."""
+class Gateway:
+    """State of one OpenTherm gateway (ot_mqtt_esp).
+
+    Frames from 't_esp' are decoded and published under 't_ot'. Its entities
+    are available while 't_state' is online, the state topic with the last
+    will of this process, default '<t_ot>/state'.
+    """
+
+    def __init__(self, t_esp, t_ot, default=True, t_state=None):
+        self.t_esp = t_esp
+        self.t_ot = t_ot
+        self.name = t_esp.replace("/", "_")
+        self.default = default
+        # Discovery attributes of its frames, other gateways need their own ids
+        self.attrs = {"t_ot": t_ot}
+        t_state = t_state or f"{t_ot}/state"
+        if not default:
+            self.attrs |= {
+                "node_id": f"OpenThermGW_{self.name}",
+                "uid_prefix": f"otgw_{self.name}",
+                "tpl": gateway_tpl(t_esp, t_state, self.name),
+            }
+        elif t_state != f"{t_ot}/state":
+            self.attrs["tpl"] = gateway_tpl(t_esp, t_state)
+        self.rcvd = 0
+        self.state = None
+        # Register filter: data_id -> allowed, see 'set_filter'
+        self.include = self.exclude = ""
+        self.allowed = bytearray(b"\x01" * 256)
+        self.filtered = 0
+        # Value-distribution profiles of the unknown registers
+        self.profiler = Profiler()
+        self.clear()
+        return
 
-    def __init__(self, token, chat_id):
-        self.TOKEN = token
-        self.chat_id = chat_id
+    def clear(self):
+        # Message Cache
+        self.msgs = {"m": {}, "s": {}}
+        # Last raw frame per register, for rediscovery
+        self.frames = {"m": {}, "s": {}}
         return
 
-    def send(self, message = f"hello from {sys.argv[0]}"):
+    def set_filter(self, include="", exclude=""):
+        """Allow the registers in 'include' (all if empty), except 'exclude'."""
+        self.include, self.exclude = include, exclude
+        self.update_filter()
         return
-        url = f"https://api.telegram.org/bot{self.TOKEN}/sendMessage?chat_id={self.chat_id}&text={message}"
-        js = requests.get(url).json()
-        # print(js)
+
+    def update_filter(self):
+        """Recompute the allowed registers, e.g. after a register table change."""
+        ot = OpenThermApplProtocol.OT
+        inc, exc = register_set(self.include, ot), register_set(self.exclude, ot)
+        self.allowed = bytearray((inc is None or r in inc) and not (exc and r in exc)
+                                 for r in range(256))
+        if not any(self.allowed):
+            logger.warning(f"{self.t_esp}: the register filter drops all registers")
+        for ms in ("m", "s"):
+            for r in [r for r in self.frames[ms] if not self.allowed[r]]:
+                del self.frames[ms][r]
+                self.msgs[ms].pop(r, None)
         return
 
+    def frame(self, raw):
+        """Construct OT frame with factory function, for this gateway."""
+        frame = OpenThermApplProtocol.from_frame(raw)
+        frame.__dict__.update(self.attrs)
+        return frame
+
+
+def owns(t_esp):
+    """True if this instance decodes gateway 't_esp', always if not clustered."""
+    return assignment is None or assignment.owns(t_esp)
+
+
+def register_set(spec, ot):
+    """The data_ids selected by 'spec', None if empty.
+
+    Spec: comma or white space separated data_ids, ranges like '100-127',
+    DataObject names or SubClass names. Registers not in 'ot' have SubClass
+    'OpenThermApplProtocol'. Tokens which select nothing are logged.
+    """
+    tokens = spec.replace(",", " ").split()
+    if not tokens:
+        return None
+    ids, names = set(), set()
+    for tok in tokens:
+        lo, _, hi = tok.partition("-")
+        if lo.isdigit() and (not hi or hi.isdigit()):
+            if int(lo) > 255 or int(hi or lo) < int(lo):
+                logger.warning(f"Register '{tok}' in '{spec}' selects no data_id")
+            ids.update(range(int(lo), min(int(hi or lo), 255) + 1))
+        else:
+            names.add(tok)
+    matched = set()
+    for r in range(256):
+        d = ot.get(r, {"DataObject": None, "SubClass": "OpenThermApplProtocol"})
+        dobj = d["DataObject"]
+        found = names & ({d["SubClass"]} | set(dobj if isinstance(dobj, list) else [dobj]))
+        if found:
+            ids.add(r)
+            matched |= found
+    for name in sorted(names - matched):
+        logger.warning(f"Register '{name}' in '{spec}' matches no DataObject or SubClass")
+    return ids
+
+
+def staleness_registers(spec):
+    """The data_ids with staleness detection, see 'register_set'."""
+    return frozenset(register_set(spec, OpenThermApplProtocol.OT) or ())
+
+
+def gateway_tasks(t_esp):
+    """Subscription tasks of gateway 't_esp': topic -> handler."""
+    return {
+        f"{t_esp}/state": process_state,
+        f"{t_esp}/master": process_master,
+        f"{t_esp}/slave": process_slave,
+        f"{t_esp}/batch": process_batch,
+        f"{t_esp}/active": process_timeout,
+        f"{t_esp}/temp": process_temp,
+    }
+
+
+def gateway_of(message):
+    """The gateway of a message on topic '<OTGW_topic>/<subtopic>'."""
+    global gateways
+    return gateways[message.topic.value.rsplit("/", 1)[0]]
+
 
 def updated(frame, msgs):
     """Update data_value belonging to data_id if needed. Return true if updated.
@@ -76,59 +252,217 @@ def updated(frame, msgs):
     return True
 
 
-def desc_sent(frame):
+def desc_sent(gw, frame):
     """Check if frame description has been sent."""
-    global args, msgs_master, msgs_slave
+    global args
     if not args.informative:
         return False
     reg = frame.data_id()
-    if reg in msgs_master or reg in msgs_slave:
+    if reg in gw.msgs["m"] or reg in gw.msgs["s"]:
         return True
     return False
 
-async def process_ms(client, message, cache, ms, ms_desc):
-    """Process OT master/slave frame.
+async def staleness_monitor(client, interval=1.0):
+    """Mark registers which stopped updating as not available."""
+    global staleness, logger
+    while True:
+        await asyncio.sleep(interval)
+        for gw, ms, reg in staleness.expire(time.monotonic()):
+            client.put(f"{gw.t_ot}/{reg}/{ms}_available", payload="offline", retain=True)
+            logger.warning(f"{gw.t_esp}: register {ms}{reg} is stale")
+
+
+def parse_frame(text):
+    """Parse hex string 'text' of a frame, None if not a 32 bits hex number."""
+    try:
+        raw = int(text, 16)
+    except ValueError:
+        return None
+    return None if raw >> 32 or raw < 0 else raw
+
+
+async def process_frame(client, gw, raw, ms, text, ts=None, arrival=None):
+    """Process OT master/slave frame 'raw', received as 'text'.
+
+    With origin timestamp 'ts' and 'arrival' time (ms) the latencies are
+    tracked, and 'ts' is passed on as user property of the state messages.
 
     If not yet sent:
     - sent a home-assistant auto-discovery msg
     - sent a description message
     For each OT-register:
     - only sent MQTT msg if value has changed
-    """ 
-    global config, logger
-    th = config["MQTT"]["topic"]
-    # Construct OT frame with factory function
-    frame = OpenThermApplProtocol.from_frame(
-        int(message.payload.decode("utf-8"), 16))
+
+    The 'client' is the publish queue: state messages are coalesced by
+    topic, discovery and description messages are never dropped.
+    """
+    global logger
+    gw.rcvd += 1
+    cache, frames = gw.msgs[ms], gw.frames[ms]
+    th = gw.t_ot
+    ms_desc = ms_descs[ms]
+    if raw is not None and not gw.allowed[(raw >> 16) & 0xff]:
+        # Unwanted register, before any validation, decode or publish
+        gw.filtered += 1
+        return
+    error = "format" if raw is None else OpenThermApplProtocol.validate(raw, ms)
+    if error:
+        # Drop before any decode, cache update or publish
+        frame_errors[error] += 1
+        quarantine.append((ms, text, error))
+        logger.info(f"{ms_desc} dropped frame {text}: {error}")
+        return
+    frame = gw.frame(raw)
     if not frame.data_id() in cache:
         # Send homeassistant discovery message(s)
         await frame.mqtt_discovery(client, ms)
         logger.info(f"Discovery msg for {ms}_{frame.data_id()}")
-    if not desc_sent(frame):
-        # Send description, dataobject, and R/W info from spec
-        t, p = frame.mqtt_desc()
-        await client.publish(f"{th}/{t}", payload=p, retain=True)
-        t, p = frame.mqtt_dataobject()
-        await client.publish(f"{th}/{t}", payload=p, retain=True)
-        t, p = frame.mqtt_rw()
-        await client.publish(f"{th}/{t}", payload=p, retain=True)
+    if not desc_sent(gw, frame):
+        await publish_desc(client, gw, frame)
+    reg = frame.data_id()
+    if (reg in OpenThermApplProtocol.entity_availability
+            and staleness.seen((gw, ms, reg), time.monotonic())):
+        client.put(f"{th}/{reg}/{ms}_available", payload="online", retain=True)
+    unknown = OpenThermApplProtocol.OT[reg]["SubClass"] == "OpenThermApplProtocol"
+    gw.profiler.observe(ms, reg, frame.data_value(), time.monotonic(), unknown)
+    if rules and (ms, reg) in rules.index:
+        for rule, active, v in rules.evaluate(gw, ms, reg, frame.decode_value(), time.monotonic()):
+            alert(client, gw, rule, active, v)
+    frames[reg] = frame.frame
+    old = cache.get(reg)
+    kwargs = {}
+    if ts is not None:
+        latency.transport(reg, ts, arrival)
+        kwargs["properties"] = publish_properties(ts)
     if updated(frame, cache):  # Side-effect: stored in cache
+        if ms == "s" and reg in (0, 5):
+            check_fault(gw, reg, old, frame.data_value())
+        if history:
+            history.add(gw.t_esp, ms, reg, frame.data_value(), arrival if ts is None else ts)
         # Only publish updated values
-        t, p = frame.mqtt_msg(ms)
-        await client.publish(f"{th}/{t}", payload=p)
-        logger.debug(f"{ms_desc} updated transfer: {hex(frame.frame)} -> t={th}/{t} p={p}")
+        meta = (reg, arrival) if arrival is not None else None
+        for t, p, retain in frame.mqtt_msgs(ms, old):
+            client.put(f"{th}/{t}", payload=p, retain=retain, meta=meta, **kwargs)
+            logger.debug(f"{ms_desc} updated transfer: {hex(frame.frame)} -> t={th}/{t} p={p}")
+    return
+
+
+async def publish_desc(client, gw, frame):
+    """Send description, dataobject, and R/W info from spec."""
+    th = gw.t_ot
+    t, p = frame.mqtt_desc()
+    await client.publish(f"{th}/{t}", payload=p, retain=True)
+    t, p = frame.mqtt_dataobject()
+    await client.publish(f"{th}/{t}", payload=p, retain=True)
+    t, p = frame.mqtt_rw()
+    await client.publish(f"{th}/{t}", payload=p, retain=True)
+    return
+
+
+def alert(client, gw, rule, active, value):
+    """Publish and notify a raised or cleared alert."""
+    global logger
+    p = serializer.text_dumps({"active": active, "value": value, "rule": rule.text})
+    client.put(f"{gw.t_ot}/alert/{rule.name}", payload=p, retain=True)
+    what = "raised" if active else "cleared"
+    notifier.notify(f"{gw.t_esp}: alert {rule.name} {what}, {rule.text}: {value}")
+    logger.warning(f"{gw.t_esp}: alert {rule.name} {what}, value {value}")
+    return
+
+
+async def rules_monitor(client, interval=1.0):
+    """Raise the alerts whose condition held for their duration."""
+    global rules
+    while True:
+        await asyncio.sleep(interval)
+        for rule, gw, v in rules.tick(time.monotonic()):
+            alert(client, gw, rule, True, v)
+
+
+def check_fault(gw, reg, old, value):
+    """Notify a change of the boiler fault: slave status 'Fault', ASF flags."""
+    if reg == 0:
+        fault, was = value & 1, (old or 0) & 1
+        if fault != was:
+            notifier.notify(f"{gw.t_esp}: boiler fault {'set' if fault else 'cleared'}")
+    elif value and value != old:
+        notifier.notify(f"{gw.t_esp}: ASF flags {value >> 8:#04x}, OEM fault code {value & 0xff}")
+    return
+
+
+async def process_ms(client, message, ms):
+    """Process OT master/slave frame message, a hex string."""
+    arrival = now_ms()
+    text = message.payload.decode("utf-8", "replace")
+    await process_frame(client, gateway_of(message), parse_frame(text), ms, text,
+                        origin_timestamp(message), arrival)
     return
 
 
 async def process_slave(client, message):
-    global msgs_slave
-    await process_ms(client, message, msgs_slave, "s", "Slave ")
+    await process_ms(client, message, "s")
     return
 
 
 async def process_master(client, message):
-    global msgs_master
-    await process_ms(client, message, msgs_master, "m", "Master")
+    await process_ms(client, message, "m")
+    return
+
+
+def parse_batch(payload):
+    """Parse a batch of frames, return list of (ms, raw, text, timestamp).
+
+    Text: one frame per line, '<m|s> <hex> [<timestamp ms>]'.
+    Binary: header 'OTB1' + u64 base timestamp (ms), followed by records of
+    u8 direction (0: master, 1: slave), u32 frame and u16 time offset (ms),
+    all big-endian.
+    Timestamps are None when unknown. A binary batch shorter than its header
+    and a trailing partial record are format errors.
+    """
+    if payload[:4] == BATCH_MAGIC:
+        if len(payload) < BATCH_HEADER.size:
+            frame_errors["format"] += 1
+            quarantine.append(("-", payload.hex(), "format"))
+            return []
+        _, base = BATCH_HEADER.unpack_from(payload)
+        body = payload[BATCH_HEADER.size:]
+        partial = len(body) % BATCH_RECORD.size
+        if partial:
+            frame_errors["format"] += 1
+            quarantine.append(("-", body[-partial:].hex(), "format"))
+            body = body[:-partial]
+        return [("s" if d else "m", raw, f"{raw:08x}", base + dt if base else None)
+                for d, raw, dt in BATCH_RECORD.iter_unpack(body)]
+    batch = []
+    for line in payload.decode("utf-8", "replace").splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        ms = fields[0] if fields[0] in ("m", "s") else None
+        text = fields[1] if len(fields) > 1 else fields[0]
+        ts = int(fields[2]) if len(fields) > 2 and fields[2].isdigit() else None
+        if ms is None:
+            frame_errors["format"] += 1
+            quarantine.append(("-", line, "format"))
+            continue
+        batch.append((ms, parse_frame(text), text, ts))
+    return batch
+
+
+async def process_batch(client, message):
+    """Process a batch of OT master/slave frames in one pass.
+
+    All resulting messages are queued before the sender task runs, so they
+    are published together.
+    """
+    global logger
+    arrival = now_ms()
+    gw = gateway_of(message)
+    batch = parse_batch(message.payload)
+    origin = origin_timestamp(message)
+    for ms, raw, text, ts in batch:
+        await process_frame(client, gw, raw, ms, text, ts or origin, arrival)
+    logger.debug(f"Batch of {len(batch)} frames from {gw.t_esp}")
     return
 
 
@@ -136,7 +470,10 @@ async def process_state(client, message):
     global online, logger
     m = message.payload.decode('utf-8')
     online = m.startswith('online')
-    # telegram.send(f"OT State: {m}")
+    gw = gateway_of(message)
+    if m != gw.state:
+        gw.state = m
+        notifier.notify(f"{gw.t_esp}: gateway {m}")
     logger.warning(f"Gateway state {m}")
     return
 
@@ -144,7 +481,7 @@ async def process_state(client, message):
 async def process_temp(client, message):
     global logger
     m = message.payload.decode('utf-8')
-    # telegram.send(f"OT Temp: {m}")
+    # notifier.notify(f"OT Temp: {m}")
     logger.info(f"Gateway temperature {m}")
     return
 
@@ -152,23 +489,34 @@ async def process_temp(client, message):
 async def process_timeout(client, message):
     global logger
     m = message.payload.decode('utf-8')
-    telegram.send(f"OT Active: {m}")
+    notifier.notify(f"{gateway_of(message).t_esp}: OT Active: {m}")
     logger.debug(f"OT timeout: {m}")
     return
 
 
 async def process_dump_state(client, message):
-    global logger, msgs_slave, msgs_master
+    global logger, gateways
     m = message.payload.decode('utf-8')
-    with open("ot_master.json", "w") as f:
-        f.write(json.dumps(dict(sorted(msgs_master.items())), indent=2))
-    with open("ot_slave.json", "w") as f:
-        f.write(json.dumps(dict(sorted(msgs_slave.items())), indent=2))
-    # telegram.send(f"OT msgs in 'ot_master.json' and 'ot_slave.json'")
+    for gw in gateways.values():
+        # The default gateway, or the only one, in 'ot_*.json'
+        prefix = "ot" if gw.default or len(gateways) == 1 else gw.name
+        with open(f"{prefix}_master.json", "w") as f:
+            f.write(json.dumps(dict(sorted(gw.msgs["m"].items())), indent=2))
+        with open(f"{prefix}_slave.json", "w") as f:
+            f.write(json.dumps(dict(sorted(gw.msgs["s"].items())), indent=2))
+    # notifier.notify(f"OT msgs in 'ot_master.json' and 'ot_slave.json'")
     with open("OT.json", "w") as f:
         json.dump(OpenThermApplProtocol.OT, f, indent=2)
-    # telegram.send(f"OT table in 'OT.json'")
-    logger.debug(f"Last master/slave transfers have been dumped in 'ot_master.json' and 'ot_slave.json'")
+    with open("ot_errors.json", "w") as f:
+        json.dump({"counters": frame_errors, "quarantine": list(quarantine)}, f, indent=2)
+    with open("ot_latency.json", "w") as f:
+        json.dump(latency.report(), f, indent=2)
+    with open("ot_profile.json", "w") as f:
+        json.dump({gw.t_esp: gw.profiler.report() for gw in gateways.values()}, f, indent=2)
+    with open("ot_loop.json", "w") as f:
+        json.dump(loop_monitor.report(), f, indent=2)
+    # notifier.notify(f"OT table in 'OT.json'")
+    logger.debug(f"Last master/slave transfers have been dumped in 'ot_master.json' and 'ot_slave.json', frame errors in 'ot_errors.json', latencies in 'ot_latency.json', profiles in 'ot_profile.json', loop lag in 'ot_loop.json'")
     return
 
 
@@ -177,35 +525,410 @@ async def clear_cache(client):
     (Re-)Send all discovery messages for all available OpenTherm registers.
     By clearing the cache in ot_mqtt_esp.
     """
-    global logger, msgs_master, msgs_slave
-    msgs_master = {}
-    msgs_slave = {}
-    # AND clear the cache in ot_mqtt_esp
-    global t_esp
-    t, p = f"{t_esp}/cmd", "clear"
-    await client.publish(t, payload=p)
+    global logger, gateways
+    for gw in gateways.values():
+        if not owns(gw.t_esp):
+            continue
+        gw.clear()
+        # AND clear the cache in ot_mqtt_esp
+        t, p = f"{gw.t_esp}/cmd", "clear"
+        await client.publish(t, payload=p)
+    return
+
+
+async def rediscover(client):
+    """Re-announce the discovery messages of all known registers.
+
+    First all discovery messages, then the current state values, paced at
+    'rediscovery_rate' messages per second. Neither the local cache nor
+    the cache in ot_mqtt_esp is cleared.
+    """
+    global config, logger, gateways
+    paced = PacedPublisher(client, float(config["MQTT"]["rediscovery_rate"]))
+    known = [(gw, ms, f) for gw in list(gateways.values())
+             for ms in ("m", "s") for f in list(gw.frames[ms].values())]
+    for gw, ms, f in known:
+        frame = gw.frame(f)
+        await frame.mqtt_discovery(paced, ms)
+    for gw, ms, f in known:
+        frame = gw.frame(f)
+        for t, p, retain in frame.mqtt_msgs(ms):
+            await paced.wait()
+            client.put(f"{gw.t_ot}/{t}", payload=p, retain=retain)
+    logger.info(f"Rediscovered {len(known)} registers")
+    return
+
+
+def start_rediscovery(client):
+    """Run rediscovery in the background, restarting a running one."""
+    global rediscovery
+    if rediscovery and not rediscovery.done():
+        rediscovery.cancel()
+    rediscovery = asyncio.create_task(rediscover(client))
+    return
+
+
+def load_registers(path):
+    """Register table: the built-in table updated with the 'path' JSON file.
+
+    The file has the format of 'OT.json' written by the dump command,
+    registers not in the file are taken from the built-in table.
+    """
+    ot = copy.deepcopy(OT_builtin)
+    if path:
+        with open(path) as f:
+            ot |= {int(r): d for r, d in json.load(f).items()}
+    for r, d in ot.items():
+        check_register(r, d)
+    return ot
+
+
+def check_register(r, d):
+    """Raise ValueError if entry 'd' of register 'r' lacks what its SubClass needs."""
+    if not isinstance(d, dict):
+        raise ValueError(f"Register {r}: not an object")
+    subcl = d.get("SubClass")
+    cls = OpenThermApplProtocol.subclass(subcl)
+    if cls is None:
+        raise ValueError(f"Register {r}: unknown SubClass {subcl}")
+    keys = ["Description", "R/W", "DataObject"]
+    for group in cls.flag_groups:
+        keys += [group, f"{group}_enabled", f"{group}_device_class"]
+    missing = [k for k in keys if k not in d]
+    if missing:
+        raise ValueError(f"Register {r}: {subcl} needs {', '.join(missing)}")
+    for group in cls.flag_groups:
+        if not all(isinstance(d[k], list) and len(d[k]) == 8
+                   for k in (group, f"{group}_enabled", f"{group}_device_class")):
+            raise ValueError(f"Register {r}: {group} needs lists of 8 flags")
+    if isinstance(d["DataObject"], list) and not (
+            isinstance(d["Description"], list) and len(d["Description"]) == len(d["DataObject"])):
+        raise ValueError(f"Register {r}: a Description per DataObject needed")
+    return
+
+
+async def reload_registers(client):
+    """Reload the register table and re-announce the changed registers.
+
+    The last frames of the changed registers are announced again:
+    discovery, description and state. They are not processed as new
+    frames, so no notifications, history or staleness updates.
+    """
+    global config, logger, gateways
+    try:
+        new = load_registers(config["MQTT"]["registers"])
+    except (OSError, ValueError) as e:
+        logger.error(f"Register table not reloaded: {e}")
+        return
+    ot = OpenThermApplProtocol.OT
+    # Keep the placeholders of unknown registers, not (yet) in the new table
+    for r, d in ot.items():
+        if r not in new and d.get("SubClass") == "OpenThermApplProtocol":
+            new[r] = d
+    changed = sorted(r for r in ot.keys() | new.keys() if ot.get(r) != new.get(r))
+    for r in changed:
+        if r in new:
+            ot[r] = new[r]
+        else:
+            del ot[r]
+    OpenThermApplProtocol.clear_payloads()
+    if staleness:
+        OpenThermApplProtocol.entity_availability = staleness_registers(config["MQTT"]["staleness"])
+    for gw in gateways.values():
+        # Names in the filter may select other registers now
+        gw.update_filter()
+        for ms in ("m", "s"):
+            for r in changed:
+                if r in gw.frames[ms]:
+                    try:
+                        await reannounce(client, gw, ms, gw.frames[ms][r])
+                    except Exception as e:
+                        logger.error(f"Register {r} not re-announced: {e!r}")
+    logger.warning(f"Reloaded register table, changed registers {changed}")
+    return
+
+
+async def reannounce(client, gw, ms, raw):
+    """Discovery, description and state of the cached frame 'raw'."""
+    frame = gw.frame(raw)
+    await frame.mqtt_discovery(client, ms)
+    await publish_desc(client, gw, frame)
+    for t, p, retain in frame.mqtt_msgs(ms):
+        client.put(f"{gw.t_ot}/{t}", payload=p, retain=retain)
     return
 
 
 async def process_discovery(client, message):
-    global logger, msgs_master, msgs_slave
+    global logger
     m = message.payload.decode('utf-8')
     logger.info(f"Homeassistant autodiscovery {m}")
     if m != "online":
         return
-    await clear_cache(client)
+    start_rediscovery(client)
+    return
+
+
+async def process_leader(client, message):
+    """Claim of the leadership of the cluster."""
+    election.on_leader(message.payload)
+    return
+
+
+async def process_member(client, message):
+    """Heartbeat of an instance of the cluster."""
+    assignment.on_member(message.payload)
+    return
+
+
+async def process_assign(client, message):
+    """Assignment of the gateways to the instances of the cluster."""
+    assignment.on_assign(message.payload)
+    return
+
+
+async def ownership_changed(client, qos, added, removed):
+    """Subscribe to the gateways gained, unsubscribe from those lost.
+
+    The caches of a gateway are cleared on a change: a gained gateway is
+    asked to send all its registers again, the state of a lost one is
+    decoded by another instance.
+    """
+    global gateways
+    for t_esp in removed:
+        await client.unsubscribe(list(gateway_tasks(t_esp)))
+        forget(gateways[t_esp])
+    for t_esp in added:
+        forget(gateways[t_esp])
+        await client.subscribe([(t, qos) for t in gateway_tasks(t_esp)])
+        await client.publish(f"{t_esp}/cmd", payload="clear")
+    return
+
+
+def forget(gw):
+    """Clear the caches, staleness timers and alert states of gateway 'gw'."""
+    gw.clear()
+    if staleness:
+        staleness.forget([k for k in staleness.entries if k[0] is gw])
+    if rules:
+        rules.forget(gw)
+    return
+
+
+async def process_ot_state(client, message):
+    """Own '<topic>/state' in a cluster, 'offline' is the will of an instance."""
+    await election.on_state(client, message.payload, message.retain)
     return
 
 
 async def process_command(client, message):
-    global logger
+    global logger, gateways
     m = message.payload.decode('utf-8')
     if m == "clear":
         await clear_cache(client)
-    logger.debug(f"Cleared otmqtt cache and (Re)Send all discovery messages.")
+        logger.debug(f"Cleared otmqtt cache and (Re)Send all discovery messages.")
+    elif m == "rediscover":
+        start_rediscovery(client)
+        logger.debug(f"(Re)Send all discovery messages.")
+    elif m == "reload":
+        await reload_registers(client)
+    elif m == "profile":
+        # Profiles of the unknown registers, on demand
+        for gw in gateways.values():
+            await client.publish(f"{gw.t_ot}/profile",
+                                 payload=serializer.text_dumps(gw.profiler.report()))
+    return
+
+
+def check_query(q):
+    """Raise ValueError if a parameter of query 'q' is not valid."""
+    if not isinstance(q, dict):
+        raise ValueError("Query is not a JSON object")
+    ms = q.get("ms", "ms")
+    if not isinstance(ms, str) or not ms or set(ms) - {"m", "s"}:
+        raise ValueError(f"Invalid ms {ms!r}, expected 'm', 's' or 'ms'")
+    ids = q.get("ids")
+    if ids is not None and not (isinstance(ids, list)
+                                and all(type(r) is int for r in ids)):
+        raise ValueError(f"Invalid ids {ids!r}, expected a list of data_ids")
+    for k, types in (("id", (int,)), ("start", (int, float)), ("end", (int, float)),
+                     ("limit", (int,))):
+        v = q.get(k)
+        if v is not None and type(v) not in types:
+            raise ValueError(f"Invalid {k} {v!r}, expected a number")
+    if not isinstance(q.get("gateway", ""), str):
+        raise ValueError(f"Invalid gateway {q['gateway']!r}, expected an OTGW_topic")
     return
 
 
+def history_rows(q):
+    """Rows of the history answering query 'q', blocking."""
+    if not history:
+        return []
+    return history.query(q.get("gateway"), q.get("ms"), q.get("id"),
+                         q.get("start"), q.get("end"),
+                         min(max(1, q.get("limit", 1000)), QUERY_LIMIT))
+
+
+def query_items(q, rows=None):
+    """Items answering query 'q', see 'process_query'.
+
+    The 'rows' of a history query are those of 'history_rows'.
+    """
+    global gateways
+    check_query(q)
+    what = q.get("what", "state")
+    ids = set(q["ids"]) if q.get("ids") else None
+    if what == "meta":
+        return [{"id": r} | d for r, d in sorted(OpenThermApplProtocol.OT.items())
+                if ids is None or r in ids]
+    if what == "state":
+        items = []
+        for gw in gateways.values():
+            if q.get("gateway", gw.t_esp) != gw.t_esp or not owns(gw.t_esp):
+                continue
+            for ms in q.get("ms", "ms"):
+                for r, raw in sorted(gw.frames[ms].items()):
+                    if ids is None or r in ids:
+                        v = f"{raw:08x}" if q.get("raw") else gw.frame(raw).decode_value()
+                        items.append({"gateway": gw.t_esp, "ms": ms, "id": r, "value": v})
+        return items
+    if what == "errors":
+        return [{"counters": frame_errors, "quarantine": list(quarantine)}]
+    if what == "latency":
+        return [{"id": r} | h for r, h in latency.report().items() if ids is None or r in ids]
+    if what == "profile":
+        return [{"gateway": gw.t_esp} | gw.profiler.report() for gw in gateways.values()
+                if owns(gw.t_esp)]
+    if what == "staleness":
+        if not staleness:
+            return []
+        now = time.monotonic()
+        return [{"gateway": gw.t_esp, "ms": ms, "id": r, "stale": e.stale,
+                 "age": round(now - e.last, 1), "interval": round(e.interval, 1),
+                 "timeout": round(staleness.timeout(e), 1)}
+                for (gw, ms, r), e in staleness.entries.items()
+                if e.n >= staleness.learn and (ids is None or r in ids)]
+    if what == "history":
+        # Decoded in the event loop, 'from_frame' may add registers to 'OT'
+        return [{"ts": ts, "gateway": gw, "ms": ms, "id": r,
+                 "value": OpenThermApplProtocol.from_frame(r << 16 | v).decode_value()}
+                for ts, gw, ms, r, v in rows or []]
+    if what == "alerts":
+        return [{"gateway": gw.t_esp, "rule": rule.name, "text": rule.text, "value": v}
+                for rule, gw, v in (rules.active() if rules else [])]
+    if what == "loop":
+        return [loop_monitor.report()]
+    if what == "queue":
+        return [{"queued": len(queue), "sent": queue.sent,
+                 "coalesced": queue.coalesced, "dropped": queue.dropped,
+                 "topic_aliases": queue.aliases.report() if queue.aliases else None}]
+    raise ValueError(f"Unknown query '{what}'")
+
+
+async def process_query(client, message):
+    """Answer a query from memory, using MQTT v5 request/response.
+
+    Request, JSON: {"what": "state" | "meta" | "errors" | "latency" |
+    "profile" | "staleness" | "queue" | "history" | "loop" | "alerts",
+    "ids": [<data_id>, ...], "gateway": <OTGW_topic>, "ms": "m" | "s" | "ms",
+    "raw": false, "page_size": 50}, all optional. History: "id": <data_id>,
+    "start" and "end" in ms since the epoch, "limit": 1000. The limit and
+    the page size are clamped to [1, QUERY_LIMIT] resp. [1, QUERY_PAGE_SIZE].
+
+    The answer is published to the Response Topic of the request, default
+    '<topic>/query/response', with its Correlation Data, in pages:
+    {"page": i, "pages": n, "data": [...]}.
+
+    In a cluster, a query for a "gateway" is answered by the instance
+    owning it, other queries by all instances, each about its own gateways
+    and with its name in "instance" in every page.
+    """
+    global config, logger
+    req = message.properties
+    topic = getattr(req, "ResponseTopic", None) or f"{config['MQTT']['topic']}/query/response"
+    props = Properties(PacketTypes.PUBLISH)
+    if getattr(req, "CorrelationData", None) is not None:
+        props.CorrelationData = req.CorrelationData
+    try:
+        q = json.loads(message.payload or b"{}")
+        gateway = q.get("gateway") if isinstance(q, dict) else None
+        if gateway is not None and not owns(gateway):
+            # Answered by the instance owning the gateway
+            return
+        rows = None
+        if q.get("what") == "history":
+            check_query(q)
+            # Database query off the event loop
+            rows = await asyncio.get_running_loop().run_in_executor(None, history_rows, q)
+        items = query_items(q, rows)
+        size = min(max(1, int(q.get("page_size", 50))), QUERY_PAGE_SIZE)
+    except (ValueError, TypeError, LookupError, AttributeError, sqlite3.Error) as e:
+        p = serializer.text_dumps({"error": str(e)})
+        await client.publish(topic, payload=p, properties=props)
+        return
+    pages = max(1, -(-len(items) // size))
+    instance = {"instance": assignment.instance} if assignment else {}
+    for i in range(pages):
+        p = serializer.text_dumps({"page": i, "pages": pages,
+                                   "data": items[i * size:(i + 1) * size]} | instance)
+        await client.publish(topic, payload=p, properties=props)
+    logger.debug(f"Query {q} answered in {pages} pages to {topic}")
+    return
+
+
+def memory_subsystems():
+    """Objects accounted per subsystem."""
+    global gateways, queue
+    return {
+        "register_table": OpenThermApplProtocol.OT,
+        "value_caches": [(gw.msgs, gw.frames) for gw in gateways.values()],
+        "discovery_cache": HassDiscovery.devices,
+        "queues": (queue.fifo, queue.pending, queue.backlog) if queue else None,
+        "latency": latency.hists,
+        "profiler": [gw.profiler.profiles for gw in gateways.values()],
+        "quarantine": quarantine,
+        "staleness": staleness.entries if staleness else None,
+    }
+
+
+async def memory_monitor(client):
+    """Sample memory use, publish it on '<topic>/diag/memory', enforce the caps.
+
+    Caps, 0: no cap
+    - max_queue: messages in the publish queue, the oldest store-and-forward
+      state messages superseded by a newer one are dropped, never discovery
+      and metadata
+    - max_rss_mb: RSS, the diagnostics (latency, profiles, quarantine) are
+      cleared
+    """
+    global config, logger, gateways, queue
+    mc = config["Memory"]
+    interval = float(mc["interval"])
+    if interval <= 0:
+        return
+    memstats.start_tracing(int(mc["tracemalloc"]))
+    max_queue = int(mc["max_queue"])
+    max_rss = float(mc["max_rss_mb"]) * 2**20
+    while True:
+        await asyncio.sleep(interval)
+        report = memstats.sample(memory_subsystems(), top=int(mc["tracemalloc_top"]))
+        report["evicted"] = {}
+        if max_queue and len(queue) > max_queue and queue.backlog:
+            n = queue.trim(max_queue)
+            report["evicted"]["queue"] = n
+            logger.warning(f"Memory cap: dropped {n} queued state messages")
+        if max_rss and report["rss"] and report["rss"] > max_rss:
+            latency.hists.clear()
+            for gw in gateways.values():
+                gw.profiler.profiles.clear()
+            quarantine.clear()
+            report["evicted"]["diagnostics"] = True
+            logger.warning(f"Memory cap: RSS {report['rss'] >> 20} MB, cleared diagnostics")
+        await client.publish(f"{config['MQTT']['topic']}/diag/memory",
+                             payload=serializer.text_dumps(report), retain=True)
+        logger.info(f"Memory: {report}")
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
         prog="otmqtt",
@@ -230,13 +953,56 @@ def read_config(args):
     config["MQTT"]["tls"] = "False"
     config["MQTT"]["username"] = "XXXXX"
     config["MQTT"]["password"] = "XXXXX"
+    config["MQTT"]["reconnect_min_interval"] = "1"
     config["MQTT"]["reconnect_interval"] = "240"
-    config["MQTT"]["reconnect_max_trials"] = "4"
+    config["MQTT"]["reconnect_max_trials"] = "0"
+    config["MQTT"]["store_forward"] = "1000"
     config["MQTT"]["topic"] = "otgw"
     config["MQTT"]["lwt_message"] = "offline"
     config["MQTT"]["lwt_retain"] = "True"
     config["MQTT"]["OTGW_topic"] = "esp/mqtt_ot"
     config["MQTT"]["hass_discovery_prefix"] = "homeassistant"
+    config["MQTT"]["rediscovery_rate"] = "20"
+    config["MQTT"]["serializer"] = "json"
+    config["MQTT"]["flag_topics"] = "False"
+    config["MQTT"]["device_discovery"] = "False"
+    config["MQTT"]["registers"] = ""
+    config["MQTT"]["include"] = ""
+    config["MQTT"]["topic_aliases"] = "True"
+    config["MQTT"]["session_expiry"] = "3600"
+    config["MQTT"]["client_id"] = ""
+    config["MQTT"]["exclude"] = ""
+    config["MQTT"]["staleness"] = ""
+    config["MQTT"]["staleness_factor"] = "3"
+    config["MQTT"]["staleness_min"] = "30"
+    config["MQTT"]["staleness_max"] = "3600"
+    config["Fleet"] = {}
+    config["Fleet"]["workers"] = "0"
+    config["Fleet"]["gateways"] = ""
+    config["Fleet"]["metrics_interval"] = "60"
+    config["History"] = {}
+    config["History"]["database"] = ""
+    config["History"]["retention_days"] = "30"
+    config["History"]["batch"] = "500"
+    config["Cluster"] = {}
+    config["Cluster"]["instance"] = ""
+    config["Cluster"]["lease"] = "30"
+    config["Monitor"] = {}
+    config["Monitor"]["loop_interval"] = "0.1"
+    config["Monitor"]["loop_threshold"] = "0.1"
+    config["Memory"] = {}
+    config["Memory"]["interval"] = "300"
+    config["Memory"]["tracemalloc"] = "0"
+    config["Memory"]["tracemalloc_top"] = "0"
+    config["Memory"]["max_queue"] = "10000"
+    config["Memory"]["max_rss_mb"] = "0"
+    config["Rules"] = {}
+    config["Notify"] = {}
+    config["Notify"]["webhook"] = ""
+    config["Notify"]["rate"] = "0.2"
+    config["Notify"]["burst"] = "5"
+    config["Notify"]["queue"] = "100"
+    config["Notify"]["retries"] = "5"
     config["Telegram"] = {}
     config["Telegram"]["token"] = "666666666:XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"
     config["Telegram"]["chat_id"] = "333333333"
@@ -250,8 +1016,24 @@ def read_config(args):
     return config
 
 
-async def mqtt_client(config):
-    global args, telegram, logger
+def make_notifier(config):
+    """Notifier to Telegram and/or a webhook, if configured, else to the log."""
+    nc, tc = config["Notify"], config["Telegram"]
+    targets = []
+    if not tc["token"].startswith("666666666:"):
+        targets.append(TelegramTarget(tc["token"], tc["chat_id"]))
+    if nc["webhook"]:
+        targets.append(WebhookTarget(nc["webhook"]))
+    return Notifier(targets or [LogTarget()], int(nc["queue"]), float(nc["rate"]),
+                    float(nc["burst"]), int(nc["retries"]))
+
+
+async def mqtt_client(config, gws=None):
+    """Run the MQTT client for gateways 'gws', a list of (OTGW_topic, topic).
+
+    Default is the single gateway 'OTGW_topic' published under 'topic'.
+    """
+    global args, notifier, logger, queue, gateways, election, assignment
 
     # Use TLS, if required
     tls_params = aiomqtt.TLSParameters(
@@ -265,9 +1047,17 @@ async def mqtt_client(config):
 
     # MQTT topic prefixes
     t_ot = config["topic"]
-    global t_esp
-    t_esp = config["OTGW_topic"]
     t_hass = config["hass_discovery_prefix"]
+    if gws is None:
+        gws = [(config["OTGW_topic"], t_ot)]
+    # Availability of the entities: the state topic with the last will
+    gateways = {t_esp: Gateway(t_esp, t, default=(t_esp == config["OTGW_topic"]),
+                               t_state=f"{t_ot}/state")
+                for t_esp, t in gws}
+    # Register filter per gateway, section '[Gateway <OTGW_topic>]', else [MQTT]
+    for t_esp, gw in gateways.items():
+        gc = config.parser[f"Gateway {t_esp}"] if config.parser.has_section(f"Gateway {t_esp}") else config
+        gw.set_filter(gc.get("include", config["include"]), gc.get("exclude", config["exclude"]))
 
     # Construct last will and testament
     will = aiomqtt.Will
@@ -280,66 +1070,229 @@ async def mqtt_client(config):
         # Dump the last state of all master/slave messages
         f"{t_ot}/dump": process_dump_state,
         f"{t_ot}/cmd": process_command,
-        # OpenTherm gateway
-        f"{t_esp}/state": process_state,
-        f"{t_esp}/master": process_master,
-        f"{t_esp}/slave": process_slave,
-        f"{t_esp}/active": process_timeout,
-        f"{t_esp}/temp": process_temp,
+        # Queries using MQTT v5 request/response
+        f"{t_ot}/query": process_query,
         # Homeassistant autodiscovery
         f"{t_hass}/status": process_discovery
     }
+    for t_esp in gateways:
+        # OpenTherm gateway
+        tasks |= gateway_tasks(t_esp)
 
-    # Prepare MQTT client
-    reconnect_interval = int(config["reconnect_interval"])  # In seconds
-    trials = maxtrials = int(config["reconnect_max_trials"])
+    # Cluster: each gateway is decoded by the instance it is assigned to
+    cluster = config.parser["Cluster"]
+    if cluster["instance"]:
+        election = Election(cluster["instance"], t_ot, float(cluster["lease"]))
+        assignment = Assignment(cluster["instance"], t_ot, gateways, float(cluster["lease"]))
+        tasks |= {
+            f"{t_ot}/leader": process_leader,
+            f"{t_ot}/state": process_ot_state,
+            f"{t_ot}/member": process_member,
+            f"{t_ot}/assign": process_assign,
+        }
+
+    # Persistent session: the broker keeps the subscriptions and queues the
+    # frames while disconnected, this needs a stable client id
+    expiry = int(config["session_expiry"])
+    session = {}
+    if expiry:
+        props = Properties(PacketTypes.CONNECT)
+        props.SessionExpiryInterval = expiry
+        cid = config["client_id"] or "_".join(
+            p for p in ("otmqtt", socket.gethostname(), cluster["instance"],
+                        t_ot.replace("/", "_")) if p)
+        session = {"identifier": cid, "clean_start": False, "properties": props}
+    qos = 1 if expiry else 0
+
+    # Prepare MQTT client, reconnect with jittered exponential backoff
+    reconnect_min = float(config["reconnect_min_interval"])  # In seconds
+    reconnect_interval = float(config["reconnect_interval"])  # Max, in seconds
+    maxtrials = int(config["reconnect_max_trials"])  # 0: never give up
+    trials = 0
 
     logger.info(f"Init: {online}")
+    # Survives reconnects, store-and-forward of state updates while disconnected
+    queue = PublishQueue(backlog=int(config["store_forward"]))
+    queue.on_sent = lambda topic, meta: latency.processing(meta[0], meta[1], now_ms())
+    monitor = asyncio.create_task(memory_monitor(queue))
+    notify = asyncio.create_task(notifier.run())
+    if rules:
+        alerts = asyncio.create_task(rules_monitor(queue))
+    # Event-loop lag, 0: off
+    loop_monitor.interval = float(config.parser["Monitor"]["loop_interval"])
+    loop_monitor.threshold = float(config.parser["Monitor"]["loop_threshold"])
+    if loop_monitor.interval > 0:
+        lag_monitor = asyncio.create_task(loop_monitor.run())
+    if staleness:
+        stale_monitor = asyncio.create_task(staleness_monitor(queue))
+    # Reload the register table on SIGHUP
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGHUP, lambda: asyncio.ensure_future(reload_registers(queue)))
 
-    # Run the MQTT client and reconnect few times if needed
-    while trials:  # True
-        async with aiomqtt.Client(
-                hostname=config["host"], port=int(config["port"]),
-                username=config["username"], password=config["password"],
-                protocol=mqtt.MQTTv5, tls_params=tls_params,
-                logger=logger,
-                will=will) as client:
-            logger.info("Connected mqtt")
-            await client.publish(f"{t_ot}/state", payload=f"online", retain=True)
-            await client.publish(f"{t_ot}/trial", payload=f"{maxtrials - trials + 1}")
-            # Clear the transfer cache in the OpenTherm gateway monitor
-            await client.publish(f"{t_esp}/cmd", payload="clear")
-            for k in tasks.keys():
-                await client.subscribe(k)
-            async for message in client.messages:
-                logger.info(f"rcvd: {message.topic.value:20} {message.payload}")
-                await tasks[message.topic.value](client, message)
-        logger.warning(f"Trial {maxtrials - trials + 1}")
-        await asyncio.sleep(reconnect_interval)
-        trials -= 1
-    logger.error(f'Giving up after {maxtrials} trials.')
-    return 0
+    # Run the MQTT client and reconnect if needed
+    while True:
+        try:
+            async with Client(
+                    hostname=config["host"], port=int(config["port"]),
+                    username=config["username"], password=config["password"],
+                    protocol=mqtt.MQTTv5, tls_params=tls_params,
+                    logger=logger,
+                    will=will, **session) as client:
+                logger.info(f"Connected mqtt, session present {client.session_present}")
+                if not election:
+                    # Else published by the leader
+                    await client.publish(f"{t_ot}/state", payload=f"online", retain=True)
+                await client.publish(f"{t_ot}/trial", payload=f"{trials + 1}")
+                trials = 0
+                for gw in gateways.values():
+                    if assignment or client.session_present and gw.rcvd:
+                        # Frames sent while disconnected are queued by the broker,
+                        # in a cluster the owner clears its gateways
+                        continue
+                    # Clear the transfer cache in the OpenTherm gateway monitor
+                    await client.publish(f"{gw.t_esp}/cmd", payload="clear")
+                # All subscriptions in one SUBSCRIBE, in a cluster those of the
+                # gateways once they are assigned
+                await client.subscribe([(k, qos) for k in tasks.keys()
+                                        if not (assignment and k.rsplit("/", 1)[0] in gateways)])
+                if client.session_present:
+                    # Subscriptions of an earlier run, e.g. before a rebalance
+                    stale = [k for t_esp, _ in parse_gateways(config.parser)
+                             for k in gateway_tasks(t_esp) if k not in tasks]
+                    if stale:
+                        await client.unsubscribe(stale)
+                logger.info(f"Replay {len(queue)} queued messages, {queue.dropped} dropped")
+                aliases = client.topic_alias_maximum if config["topic_aliases"] == "True" else 0
+                logger.info(f"Broker limits {client.limits()}, {aliases} topic aliases")
+                sender = asyncio.create_task(queue.sender(client, aliases))
+                elect = asyncio.create_task(election.run(queue)) if election else None
+                own = asyncio.create_task(assignment.run(
+                    queue, election, functools.partial(ownership_changed, client, qos))
+                ) if assignment else None
+                try:
+                    async for message in client.messages:
+                        logger.info(f"rcvd: {message.topic.value:20} {message.payload}")
+                        handler = tasks.get(message.topic.value)
+                        if handler is None:
+                            # Left over in a resumed session
+                            logger.warning(f"Unsubscribe unknown topic {message.topic.value}")
+                            await client.unsubscribe(message.topic.value)
+                            continue
+                        with loop_monitor.handling(handler.__name__):
+                            await handler(queue, message)
+                finally:
+                    sender.cancel()
+                    for task in (elect, own):
+                        if task:
+                            task.cancel()
+        except aiomqtt.MqttError as e:
+            trials += 1
+            if maxtrials and trials >= maxtrials:
+                logger.error(f'Giving up after {trials} trials.')
+                raise
+            logger.warning(f"Trial {trials}: {e}")
+        delay = min(reconnect_interval, reconnect_min * 2 ** min(trials, 16))
+        delay *= random.uniform(0.5, 1.0)
+        logger.warning(f"Reconnect in {delay:.1f}s")
+        await asyncio.sleep(delay)
     
 
-def main():
-    global args, config, telegram, logger
-    args = parse_arguments()
+async def report_metrics(n, metrics, interval=10):
+    """Fleet worker: report metrics to the supervisor."""
+    global gateways, queue
+    while True:
+        await asyncio.sleep(interval)
+        metrics.put({
+            "worker": n,
+            "gateways": len(gateways),
+            "frames": sum(gw.rcvd for gw in gateways.values()),
+            "filtered": sum(gw.filtered for gw in gateways.values()),
+            "errors": dict(frame_errors),
+            "sent": queue.sent if queue else 0,
+            "coalesced": queue.coalesced if queue else 0,
+        })
+
+
+async def worker_client(config, n, gws, metrics):
+    await asyncio.gather(mqtt_client(config, gws), report_metrics(n, metrics))
+
+
+def run_worker(worker_args, n, gws, metrics):
+    """Entry point of fleet worker 'n' for gateways 'gws'."""
+    global args, config, notifier, logger
+    args = worker_args
     config = read_config(args)
+    setup(f"mqtt_ot_worker{n}.log")
+    # Own topics for state, dump and cmd of this worker
+    config["MQTT"]["topic"] = f"{config['MQTT']['topic']}/worker{n}"
+    notifier = make_notifier(config)
+    try:
+        asyncio.run(worker_client(config["MQTT"], n, gws, metrics))
+    except KeyboardInterrupt:
+        return 2
+    finally:
+        if history:
+            history.close()
+    return 0
+
 
+def setup(filename="mqtt_ot.log"):
+    """Configure the decoder classes and logging."""
+    global args, config, logger, staleness, history, rules
+    # First, 'register_set' logs the unknown registers
+    setup_logging(filename)
     OpenThermApplProtocol.hass_prefix = config["MQTT"]["hass_discovery_prefix"]
     OpenThermApplProtocol.OT = OT
+    OT.clear()
+    OT.update(load_registers(config["MQTT"]["registers"]))
+    OpenThermApplProtocol.flag_topics = config["MQTT"]["flag_topics"] == "True"
+    if config["MQTT"]["device_discovery"] == "True":
+        HassDiscovery.devices = {}
+    # Registers with staleness detection, 'False' in older config files
+    if config["MQTT"]["staleness"] not in ("", "False"):
+        staleness = StalenessTracker(float(config["MQTT"]["staleness_factor"]),
+                                     float(config["MQTT"]["staleness_min"]),
+                                     float(config["MQTT"]["staleness_max"]))
+        OpenThermApplProtocol.entity_availability = staleness_registers(config["MQTT"]["staleness"])
+    if config["Rules"]:
+        rules = RuleEngine(dict(config["Rules"]), OT)
+    if config["History"]["database"]:
+        history = HistoryStore(config["History"]["database"],
+                               float(config["History"]["retention_days"]),
+                               int(config["History"]["batch"]))
+    serializer.set_encoder(config["MQTT"]["serializer"])
+    OpenThermApplProtocol.clear_payloads()
+    return
 
+
+def setup_logging(filename="mqtt_ot.log"):
+    """Configure logging, all the fleet supervisor needs."""
+    global args, logger
     if args.verbose > 3:
         args.verbose = 3
     loglvl = {0: logging.ERROR, 1: logging.WARNING, 2: logging.INFO, 3: logging.DEBUG}
-    logging.basicConfig(filename = "mqtt_ot.log",
+    logging.basicConfig(filename = filename,
                         filemode = "w",
                         level = loglvl[args.verbose])
     logger = logging.getLogger("mqtt_ot")
     logger.info("Started")
+    return
+
+
+def main():
+    global args, config, notifier, logger
+    args = parse_arguments()
+    config = read_config(args)
+
+    if int(config["Fleet"]["workers"]):
+        # The workers decode, see 'run_worker'
+        setup_logging()
+        from .fleet import supervise
+        return supervise(args, config, read_config)
+    setup()
 
-    telegram = Telegram(config["Telegram"]["token"], config["Telegram"]["chat_id"])
-    telegram.send(f"{sys.argv[0]}@{socket.gethostname()} started")
+    notifier = make_notifier(config)
+    notifier.notify(f"{sys.argv[0]}@{socket.gethostname()} started")
 
     try:
         asyncio.run(mqtt_client(config["MQTT"]))
@@ -352,6 +1305,9 @@ def main():
     except KeyboardInterrupt as e:
         print(e)
         return 2
+    finally:
+        if history:
+            history.close()
     logger.info("Finished")
     return 0
 
@@ -0,0 +1,108 @@
+#! /usr/bin/env python3
+"""Value-distribution profiler for registers not specified in OpenTherm v2.2.
+
+For each unknown register (master and slave separately):
+- histograms of the high and low byte
+- toggle counts per bit
+- update cadence: number of updates, changes and mean interval
+- co-changes with other registers: number of changes of another register
+  within 'window' seconds before or after a change of this register
+
+Memory is fixed per profiled register, the number of profiled registers is
+bounded by 'max_registers'.
+"""
+from array import array
+
+MS = {"m": 0, "s": 256}  # Index offset of master/slave registers
+
+
+class RegisterProfile:
+    """Compact profile of one register."""
+
+    def __init__(self):
+        self.hb = array("I", bytes(4 * 256))
+        self.lb = array("I", bytes(4 * 256))
+        self.toggles = array("I", bytes(4 * 16))
+        self.cochanges = array("I", bytes(4 * 512))
+        self.updates = 0
+        self.changes = 0
+        self.value = None
+        self.first = None
+        self.last = None
+
+    def update(self, value, now):
+        self.updates += 1
+        self.hb[value >> 8] += 1
+        self.lb[value & 0xff] += 1
+        if self.first is None:
+            self.first = now
+        self.last = now
+        changed = self.value is not None and value != self.value
+        if changed:
+            self.changes += 1
+            diff = value ^ self.value
+            for i in range(16):
+                if (diff >> i) & 1:
+                    self.toggles[i] += 1
+        self.value = value
+        return changed
+
+    def report(self, top=5):
+        def hist(h):
+            return {f"{i:#04x}": c for i, c in enumerate(h) if c}
+
+        cadence = (self.last - self.first) / (self.updates - 1) if self.updates > 1 else None
+        co = sorted(((c, i) for i, c in enumerate(self.cochanges) if c), reverse=True)[:top]
+        return {
+            "updates": self.updates,
+            "changes": self.changes,
+            "interval": round(cadence, 3) if cadence is not None else None,
+            "value": self.value,
+            "hb": hist(self.hb),
+            "lb": hist(self.lb),
+            "toggle_freq": [round(t / self.changes, 3) if self.changes else 0
+                            for t in self.toggles],
+            "cochanges": {f"{'ms'[i >> 8]}{i & 0xff}": c for c, i in co},
+        }
+
+
+class Profiler:
+    """Profiles of the unknown registers of a gateway."""
+
+    def __init__(self, window=1.0, max_registers=32):
+        self.window = window
+        self.max_registers = max_registers
+        self.profiles = {}  # index -> RegisterProfile
+        self.values = array("l", [-1] * 512)
+        self.changed = array("d", [float("-inf")] * 512)
+
+    def observe(self, ms, reg, value, now, unknown):
+        """Observe 'value' of register 'reg' from master/slave 'ms' at 'now' (s)."""
+        idx = MS[ms] + reg
+        profile = self.profiles.get(idx)
+        if unknown and profile is None and len(self.profiles) < self.max_registers:
+            profile = self.profiles[idx] = RegisterProfile()
+        if profile is not None:
+            changed = profile.update(value, now)
+        else:
+            changed = self.values[idx] not in (-1, value)
+        self.values[idx] = value
+        if not changed:
+            return
+        self.changed[idx] = now
+        since = now - self.window
+        if profile is not None:
+            # Registers which changed shortly before
+            for i, t in enumerate(self.changed):
+                if t >= since and i != idx:
+                    profile.cochanges[i] += 1
+        # Profiled registers which changed shortly before this one
+        for i, p in self.profiles.items():
+            if i != idx and self.changed[i] >= since and self.changed[i] < now:
+                p.cochanges[idx] += 1
+        return
+
+    def report(self):
+        """Profiles by register, e.g. 's113'."""
+        return {f"{'ms'[i >> 8]}{i & 0xff}": p.report()
+                for i, p in sorted(self.profiles.items())}
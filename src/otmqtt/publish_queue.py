@@ -0,0 +1,264 @@
+#! /usr/bin/env python3
+"""Coalescing publish queue for MQTT.
+
+Two kinds of messages are distinguished:
+- state messages, e.g. 'otgw/<id>/<ms>_<type>': latest value wins. Only the
+  newest payload per topic is kept, in an ordered dirty set.
+- all other messages (discovery, metadata, commands): kept in a FIFO and
+  never dropped.
+
+A sender task drains the queue into the MQTT client. FIFO messages go first,
+so a discovery message always precedes the state of its entity.
+Memory is bounded by the number of distinct state topics, not by the
+message rate.
+
+Store-and-forward: while no sender is connected, state messages are not
+coalesced but kept in a bounded backlog, which is replayed in order after
+reconnect. When the sender stops, the unsent dirty state messages are moved
+to the backlog first, so a newer payload queued during the outage is
+published after them. When the backlog is full, its oldest message is
+dropped if a newer message for its topic follows, else it moves to the
+dirty set: the latest payload of every topic is kept. This matters for
+topics published only on a change, e.g. flags in bit-diff mode.
+
+State messages may carry 'meta' data, which is handed to the 'on_sent'
+callback once the message is published, e.g. for latency tracking.
+
+State messages are published with MQTT v5 topic aliases, if the broker
+allows them: the most recently used topics keep an alias, later publishes
+carry only the alias instead of the topic.
+"""
+import asyncio
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PublishQueue:
+    """Publish queue with latest-value-wins coalescing of state topics.
+
+    Offers the 'publish' coroutine of aiomqtt.Client, so it can be handed to
+    all code which expects a client. Use 'put' for state messages.
+    """
+
+    def __init__(self, backlog=0):
+        self.fifo = collections.deque()  # (topic, payload, retain, kwargs)
+        self.pending = {}  # Ordered dirty set: topic -> (payload, retain, kwargs, meta)
+        self.backlog = collections.deque(maxlen=backlog)  # Store-and-forward
+        self.in_backlog = collections.Counter()  # topic -> messages in the backlog
+        self.event = asyncio.Event()
+        self.connected = False
+        self.on_sent = None  # Callback(topic, meta) for sent state messages
+        self.aliases = None  # TopicAliases of the connection
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.fifo) + len(self.backlog) + len(self.pending)
+
+    async def publish(self, topic, payload=None, retain=False, **kwargs):
+        """Queue a message which is never dropped."""
+        self.fifo.append((topic, payload, retain, kwargs))
+        self.event.set()
+        return
+
+    def put(self, topic, payload=None, retain=False, meta=None, **kwargs):
+        """Queue a state message, replacing a not yet sent payload for topic.
+
+        A replaced topic keeps its position in the dirty set.
+        While disconnected, the message is stored in the backlog, if enabled.
+        """
+        if not self.connected and self.backlog.maxlen:
+            self.store(topic, payload, retain, kwargs, meta)
+            return
+        if topic in self.pending:
+            self.coalesced += 1
+        self.pending[topic] = (payload, retain, kwargs, meta)
+        self.event.set()
+        return
+
+    def store(self, topic, payload, retain, kwargs, meta):
+        """Append a state message to the backlog, evicting the oldest if full."""
+        if len(self.backlog) == self.backlog.maxlen:
+            self.evict()
+        # Newer than a payload for topic in the dirty set
+        self.pending.pop(topic, None)
+        self.backlog.append((topic, payload, retain, kwargs, meta))
+        self.in_backlog[topic] += 1
+        return
+
+    def evict(self):
+        """Remove the oldest backlog message, return True if it was dropped.
+
+        It is only dropped if a newer message for its topic is in the
+        backlog, else it moves to the dirty set.
+        """
+        topic, payload, retain, kwargs, meta = self.backlog.popleft()
+        self.in_backlog[topic] -= 1
+        if self.in_backlog[topic]:
+            self.dropped += 1
+            return True
+        del self.in_backlog[topic]
+        self.pending[topic] = (payload, retain, kwargs, meta)
+        return False
+
+    def stash(self):
+        """Move the dirty state messages to the backlog, in order."""
+        if not self.backlog.maxlen:
+            return
+        pending, self.pending = self.pending, {}
+        for topic, (payload, retain, kwargs, meta) in pending.items():
+            self.store(topic, payload, retain, kwargs, meta)
+        return
+
+    def trim(self, maxlen):
+        """Reduce the backlog to stay within 'maxlen' queued messages.
+
+        Return the number dropped: only backlog messages followed by a newer
+        one for their topic, the others move to the dirty set. FIFO messages
+        are never dropped and the dirty state messages are bounded by the
+        number of topics, so the queue may remain longer than 'maxlen'.
+        """
+        n = 0
+        for _ in range(min(len(self.backlog), max(0, len(self) - maxlen))):
+            n += self.evict()
+        return n
+
+    async def flush(self, client):
+        """Publish all queued messages: FIFO, backlog, then dirty state topics.
+
+        A message is only removed from the FIFO or backlog once published. A
+        dirty state message which failed is restored, unless a newer payload
+        arrived meanwhile.
+        """
+        while True:
+            if self.fifo:
+                topic, payload, retain, kwargs = self.fifo[0]
+                await client.publish(topic, payload=payload, retain=retain, **kwargs)
+                self.fifo.popleft()
+            elif self.backlog:
+                topic, payload, retain, kwargs, meta = self.backlog[0]
+                t, kw = self.aliased(topic, kwargs)
+                await client.publish(t, payload=payload, retain=retain, **kw)
+                self.backlog.popleft()
+                self.in_backlog[topic] -= 1
+                if not self.in_backlog[topic]:
+                    del self.in_backlog[topic]
+                self.sent_state(topic, meta)
+            elif self.pending:
+                topic = next(iter(self.pending))
+                # Pop before publishing, a newer payload may arrive meanwhile
+                item = self.pending.pop(topic)
+                payload, retain, kwargs, meta = item
+                try:
+                    t, kw = self.aliased(topic, kwargs)
+                    await client.publish(t, payload=payload, retain=retain, **kw)
+                except BaseException:
+                    if topic not in self.pending:
+                        self.pending = {topic: item} | self.pending
+                    raise
+                self.sent_state(topic, meta)
+            else:
+                return
+            self.sent += 1
+
+    def aliased(self, topic, kwargs):
+        """Topic and kwargs of a state message, with its topic alias if any."""
+        if not self.aliases:
+            return topic, kwargs
+        from paho.mqtt.packettypes import PacketTypes
+        from paho.mqtt.properties import Properties
+        t, alias = self.aliases.alias(topic)
+        # Own properties, the user properties may be shared by several messages
+        props = Properties(PacketTypes.PUBLISH)
+        user = getattr(kwargs.get("properties"), "UserProperty", None)
+        if user:
+            props.UserProperty = user
+        props.TopicAlias = alias
+        return t, kwargs | {"properties": props}
+
+    def sent_state(self, topic, meta):
+        if meta is not None and self.on_sent:
+            self.on_sent(topic, meta)
+        return
+
+    async def sender(self, client, aliases=0):
+        """Sender task: drain the queue whenever messages are queued.
+
+        Use at most 'aliases' topic aliases, 0: none.
+        """
+        self.aliases = TopicAliases(aliases) if aliases else None
+        self.connected = True
+        try:
+            while True:
+                self.event.clear()
+                await self.flush(client)
+                await self.event.wait()
+        finally:
+            self.connected = False
+            self.stash()
+
+
+class TopicAliases:
+    """Topic aliases of the 'maximum' most recently used topics (LRU)."""
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.lru = collections.OrderedDict()  # topic -> alias
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved = 0  # Bytes of topics not sent
+
+    def alias(self, topic):
+        """(topic, alias) to publish, the topic is empty if the alias is set."""
+        alias = self.lru.get(topic)
+        if alias is not None:
+            self.lru.move_to_end(topic)
+            self.hits += 1
+            self.saved += len(topic.encode("utf-8"))
+            return "", alias
+        self.misses += 1
+        if len(self.lru) < self.maximum:
+            alias = len(self.lru) + 1
+        else:
+            # Reassign the alias of the least recently used topic
+            _, alias = self.lru.popitem(last=False)
+            self.evictions += 1
+        self.lru[topic] = alias
+        return topic, alias
+
+    def report(self):
+        n = self.hits + self.misses
+        return {
+            "maximum": self.maximum,
+            "used": len(self.lru),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / n, 3) if n else None,
+            "bytes_saved": self.saved,
+        }
+
+
+class PacedPublisher:
+    """Client wrapper limiting 'publish' to 'rate' messages per second."""
+
+    def __init__(self, client, rate):
+        self.client = client
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next = 0.0
+
+    async def wait(self):
+        """Wait for the next publish slot."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.next = max(self.next, now) + self.interval
+        await asyncio.sleep(self.next - self.interval - now)
+        return
+
+    async def publish(self, topic, payload=None, retain=False, **kwargs):
+        await self.wait()
+        return await self.client.publish(topic, payload=payload, retain=retain, **kwargs)
@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+"""Alert rules, evaluated on the decoded frames.
+
+A rule, one per option in the [Rules] section of the config file:
+
+  <name> = [<m|s>:]<register>[.<field>] <op> <number> [for <s>] [hysteresis <delta>]
+
+- register: data_id or DataObject name, direction default 's' (slave)
+- field: sub-value of the decoded value, e.g. a flag
+- op: < <= > >= == !=
+- for: the condition must hold 's' seconds before the alert is raised
+- hysteresis: for < and <=, the alert is cleared when the value is at
+  least 'delta' above the threshold, for > and >= below it
+
+Examples:
+
+  fault = Status.Fault == 1
+  low_pressure = CH_pressure < 1.0 for 300 hysteresis 0.1
+  oem_fault = 5.OEM_fault_code != 0
+
+The rules are indexed by (direction, data_id): a frame evaluates only the
+rules of its register. The state per rule and gateway is the start time of
+the condition and whether the alert is active.
+"""
+import operator
+import re
+
+OPS = {
+    "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+    "==": operator.eq, "!=": operator.ne,
+}
+
+RULE = re.compile(r"^\s*(?:([ms]):)?(\w+)(?:\.(\w+))?\s*(<=|>=|==|!=|<|>)\s*(-?[\d.]+)"
+                  r"(?:\s+for\s+([\d.]+))?(?:\s+hysteresis\s+([\d.]+))?\s*$")
+
+
+class Rule:
+    """Compiled alert rule 'name'."""
+
+    def __init__(self, name, text, ot):
+        m = RULE.match(text)
+        if not m:
+            raise ValueError(f"Rule {name}: syntax error in '{text}'")
+        ms, reg, field, op, threshold, duration, hysteresis = m.groups()
+        self.name = name
+        self.text = text.strip()
+        self.ms = ms or "s"
+        self.reg, self.field = self.register(reg, field, ot)
+        self.op = op
+        self.cmp = OPS[op]
+        self.threshold = float(threshold)
+        self.duration = float(duration or 0)
+        self.hysteresis = float(hysteresis or 0)
+
+    def register(self, reg, field, ot):
+        """(data_id, field) of register 'reg': a data_id or DataObject name."""
+        if reg.isdigit():
+            return int(reg), field
+        for r, d in ot.items():
+            dobj = d["DataObject"]
+            if dobj == reg:
+                return r, field
+            if isinstance(dobj, list) and reg in dobj:
+                # A sub-value: the field of the decoded value
+                return r, field or reg
+        raise ValueError(f"Rule {self.name}: unknown register '{reg}'")
+
+    def value(self, decoded):
+        """The numeric value tested by the rule, None if not available."""
+        v = decoded.get(self.field) if self.field and isinstance(decoded, dict) else decoded
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return None
+
+    def released(self, v):
+        """True if the alert is cleared by value 'v'."""
+        if not self.hysteresis or self.op in ("==", "!="):
+            return not self.cmp(v, self.threshold)
+        if self.op in ("<", "<="):
+            return v >= self.threshold + self.hysteresis
+        return v <= self.threshold - self.hysteresis
+
+
+class RuleEngine:
+    """Rules indexed by (direction, data_id), state per (rule, gateway)."""
+
+    def __init__(self, rules, ot):
+        self.rules = [Rule(name, text, ot) for name, text in rules.items()]
+        self.index = {}
+        for rule in self.rules:
+            self.index.setdefault((rule.ms, rule.reg), []).append(rule)
+        self.state = {}  # (rule, gateway) -> [since, active, value]
+
+    def evaluate(self, gw, ms, reg, decoded, now):
+        """Evaluate the rules of a frame, return the changes [(rule, active, value)]."""
+        changes = []
+        for rule in self.index.get((ms, reg), ()):
+            v = rule.value(decoded)
+            if v is None:
+                continue
+            st = self.state.setdefault((rule, gw), [None, False, v])
+            st[2] = v
+            if st[1]:
+                if rule.released(v):
+                    st[0], st[1] = None, False
+                    changes.append((rule, False, v))
+            elif rule.cmp(v, rule.threshold):
+                if st[0] is None:
+                    st[0] = now
+                if now - st[0] >= rule.duration:
+                    st[1] = True
+                    changes.append((rule, True, v))
+            else:
+                st[0] = None
+        return changes
+
+    def tick(self, now):
+        """Raise the alerts whose duration passed, return [(rule, gateway, value)]."""
+        raised = []
+        for (rule, gw), st in self.state.items():
+            if not st[1] and st[0] is not None and now - st[0] >= rule.duration:
+                st[1] = True
+                raised.append((rule, gw, st[2]))
+        return raised
+
+    def forget(self, gw):
+        """Drop the state of the rules of gateway 'gw'."""
+        for key in [k for k in self.state if k[1] is gw]:
+            del self.state[key]
+        return
+
+    def active(self):
+        return [(rule, gw, st[2]) for (rule, gw), st in self.state.items() if st[1]]
+
+
+if __name__ == "__main__":
+    from .ot_registers import OT
+    engine = RuleEngine({
+        "fault": "Status.Fault == 1",
+        "low_pressure": "CH_pressure < 1.0 for 300 hysteresis 0.1",
+        "oem_fault": "5.OEM_fault_code != 0",
+    }, OT)
+    print(sorted(engine.index))
+    for t, v in ((0, "1.2"), (10, "0.9"), (200, "0.95"), (400, "1.05"), (500, "1.15")):
+        print(t, v, [(r.name, a) for r, a, _ in engine.evaluate("gw", "s", 18, v, t)],
+              [(r.name, g) for r, g, _ in engine.tick(t + 150)])
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+"""Payload serializers for the MQTT messages.
+
+Encoders, selected with 'set_encoder':
+- json:    stdlib json (default)
+- orjson:  orjson, when installed, otherwise stdlib json
+- compact: for machine consumers, objects as MessagePack or CBOR body,
+           when installed, otherwise as JSON without whitespace
+
+'dumps' serializes state payloads with the selected encoder, 'binary' is
+set when these are not JSON text, so discovery skips the 'value_json'
+templates of object payloads.
+'text_dumps' serializes payloads which must stay JSON text, such as
+the home-assistant discovery messages and the register metadata.
+
+Run 'python -m otmqtt.serializer' to compare the encoders on real register
+payloads.
+"""
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+logger = logging.getLogger(__name__)
+
+
+def json_dumps(obj):
+    return json.dumps(obj)
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj).decode("utf-8")
+
+
+def compact_dumps(obj):
+    if msgpack:
+        return msgpack.packb(obj)
+    if cbor2:
+        return cbor2.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"))
+
+
+ENCODERS = {
+    "json": json_dumps,
+    "orjson": orjson_dumps,
+    "compact": compact_dumps,
+}
+
+encoder = "json"
+binary = False
+dumps = json_dumps
+text_dumps = json_dumps
+
+
+def set_encoder(name):
+    """Select the encoder for state payloads (and JSON text, if possible)."""
+    global encoder, binary, dumps, text_dumps
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown serializer '{name}', use one of {list(ENCODERS)}")
+    if name == "orjson" and orjson is None:
+        logger.warning("orjson not installed, using json")
+        name = "json"
+    encoder = name
+    binary = name == "compact" and (msgpack or cbor2) is not None
+    if binary:
+        logger.warning(f"compact serializer uses {'MessagePack' if msgpack else 'CBOR'}, "
+                       "home-assistant entities of object payloads are not announced")
+    dumps = ENCODERS[name]
+    text_dumps = orjson_dumps if name == "orjson" else json_dumps
+    return
+
+
+def benchmark(number=20000):
+    """Time all available encoders on real register payloads."""
+    import timeit
+    from .opentherm import OpenThermApplProtocol
+    from .ot_registers import OT
+    OpenThermApplProtocol.OT = OT
+    # Decoded values of flag and dual u8/s8 registers, as seen on the bus
+    frames = [0x40000308, 0x40030109, 0x40050000, 0xc0064d50,
+              0x400f1846, 0x40304b28, 0xc0640100, 0x407e0302]
+    objs = [OpenThermApplProtocol.from_frame(f).decode_value() for f in frames]
+    available = ["json"] + (["orjson"] if orjson else []) + ["compact"]
+    for name in available:
+        enc = ENCODERS[name]
+        t = timeit.timeit(lambda: [enc(o) for o in objs], number=number)
+        size = sum(len(enc(o)) for o in objs)
+        print(f"{name:8} {1e9 * t / number / len(objs):8.0f} ns/payload {size:5} bytes")
+    return
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,350 @@
+#! /usr/bin/env python3
+"""Synthetic OpenTherm traffic, a stand-in for the ESP OpenTherm gateway.
+
+A simulated thermostat (master) polls a simulated boiler (slave), like on
+a real OpenTherm bus: status (ID 0) every other exchange, the frequently
+used registers in between and, now and then, any other register of 'OT'.
+The boiler model has:
+- heating cycles: room temperature with hysteresis on the setpoint, burner
+  on/off with modulation, boiler and return temperatures
+- DHW draws: random tap events with flow rate and DHW temperature
+- counters which only increase: burner/pump starts and operation hours
+- a slowly varying outside temperature
+A fraction of the frames is corrupted: parity, spare bits or message type.
+
+Library use, e.g. in load tests:
+
+  sim = Simulator(seed=1)
+  for topic, payload in sim.messages("esp/mqtt_ot", 100):
+      ...
+
+Usage:
+  otmqtt-sim                        simulate the gateways of mqtt_ot.ini
+  otmqtt-sim -g 100 -r 10           100 gateways, 10 exchanges/s each
+"""
+import argparse
+import asyncio
+import math
+import random
+import sys
+import time
+from .opentherm import parity
+from .ot_registers import OT
+
+READ_DATA, WRITE_DATA = 0, 1
+READ_ACK, WRITE_ACK, UNKNOWN_DATAID = 4, 5, 7
+
+# Registers polled between the status exchanges
+FREQUENT = [1, 25, 17, 28, 26, 18, 19, 27, 16, 24, 56, 57]
+
+# Constant slave values (raw 16 bits)
+STATIC = {
+    3: 0x0109,   # DHW present, MemberID 9
+    6: 0x0303,   # Remote boiler parameters: DHW and max CH setpoint
+    15: 0x1814,  # 24 kW, min modulation 20%
+    48: 0x3c28,  # TdhwSet bounds 60/40 °C
+    49: 0x5014,  # MaxTSet bounds 80/20 °C
+    125: 0x0233,  # OpenTherm version 2.2
+    127: 0x0101,
+}
+
+
+def frame(msg_type, data_id, value):
+    """Frame with correct parity."""
+    raw = (msg_type << 28) | (data_id << 16) | (value & 0xffff)
+    return raw | (parity(raw) << 31)
+
+
+def f88(v):
+    return int(round(v * 256)) & 0xffff
+
+
+def writes(data_id):
+    """True if the master writes register 'data_id'."""
+    rw = OT[data_id]["R/W"].split()
+    return rw[0] == "-" and rw[-1] == "W"
+
+
+class Boiler:
+    """Boiler and room model, advanced in steps of 'dt' seconds."""
+
+    def __init__(self, rng, t=None):
+        self.rng = rng
+        self.t = time.time() if t is None else t
+        self.trset = 20.0
+        self.tr = rng.uniform(18.5, 20.5)
+        self.tboiler = rng.uniform(25, 40)
+        self.tdhw = 55.0
+        self.tdhwset = 55.0
+        self.maxtset = 80.0
+        self.ch = False
+        self.flame = False
+        self.draw = 0.0  # Remaining DHW draw time (s)
+        self.flow = 0.0
+        self.modulation = 0.0
+        self.pressure = rng.uniform(1.3, 1.8)
+        # Counters, seconds of operation
+        self.burner_starts = rng.randrange(1000, 20000)
+        self.ch_pump_starts = rng.randrange(1000, 20000)
+        self.dhw_pump_starts = rng.randrange(1000, 20000)
+        self.dhw_burner_starts = rng.randrange(1000, 20000)
+        self.burner_s = rng.uniform(1e6, 2e7)
+        self.ch_pump_s = self.burner_s * 1.3
+        self.dhw_pump_s = self.burner_s * 0.1
+        self.dhw_burner_s = self.burner_s * 0.08
+
+    @property
+    def toutside(self):
+        day = 2 * math.pi * (self.t % 86400) / 86400
+        return 8.0 - 6.0 * math.cos(day - 0.5)
+
+    @property
+    def tset(self):
+        if not self.ch:
+            return 10.0
+        return min(self.maxtset, max(20.0, 30 + 1.5 * (self.trset - self.toutside)))
+
+    @property
+    def tret(self):
+        return self.tboiler - (8.0 if self.flame else 2.0)
+
+    def step(self, dt=1.0):
+        rng = self.rng
+        self.t += dt
+        # Room temperature, CH demand with hysteresis
+        self.tr += dt * ((0.0006 if self.ch and self.flame else 0.0)
+                         - 1.5e-5 * (self.tr - self.toutside))
+        if self.tr < self.trset - 0.3 and not self.ch:
+            self.ch = True
+            self.ch_pump_starts += 1
+        elif self.tr > self.trset + 0.2:
+            self.ch = False
+        # DHW draws, on average one per hour
+        if self.draw > 0:
+            self.draw -= dt
+            self.tdhw += dt * (0.02 * (self.tdhwset - self.tdhw) - 0.05)
+        elif rng.random() < dt / 3600:
+            self.draw = rng.uniform(30, 300)
+            self.flow = rng.uniform(6, 10)
+            self.dhw_pump_starts += 1
+        if self.draw <= 0:
+            self.flow = 0.0
+            self.tdhw += dt * 0.01 * (self.tdhwset - self.tdhw)
+        # Burner cycling
+        dhw = self.draw > 0
+        target = self.tdhwset + 10 if dhw else self.tset
+        demand = dhw or self.ch
+        if not self.flame and demand and self.tboiler < target - 3:
+            self.flame = True
+            self.burner_starts += 1
+            if dhw:
+                self.dhw_burner_starts += 1
+        elif self.flame and (not demand or self.tboiler > target + 5):
+            self.flame = False
+        if self.flame:
+            self.modulation = min(100.0, max(0.0, 20 + 10 * (target - self.tboiler)))
+            self.tboiler += dt * 0.02 * (target + 8 - self.tboiler)
+            self.burner_s += dt
+            if dhw:
+                self.dhw_burner_s += dt
+        else:
+            self.modulation = 0.0
+            self.tboiler += dt * 0.004 * (self.tr - self.tboiler)
+        self.ch_pump_s += dt if self.ch else 0.0
+        self.dhw_pump_s += dt if dhw else 0.0
+        self.pressure += rng.gauss(0, 0.002) + 0.001 * (1.5 - self.pressure)
+        return
+
+    def master_status(self):
+        return (self.ch << 0 | 1 << 1) << 8
+
+    def slave_status(self):
+        return (self.ch << 1 | (self.draw > 0) << 2 | self.flame << 3)
+
+    def value(self, data_id):
+        """Raw 16 bits value of register 'data_id'."""
+        lt = time.localtime(self.t)
+        values = {
+            0: lambda: self.master_status() | self.slave_status(),
+            1: lambda: f88(self.tset),
+            14: lambda: f88(100),
+            16: lambda: f88(self.trset),
+            17: lambda: f88(self.modulation),
+            18: lambda: f88(self.pressure),
+            19: lambda: f88(self.flow),
+            20: lambda: (lt.tm_wday + 1) << 13 | lt.tm_hour << 8 | lt.tm_min,
+            21: lambda: lt.tm_mon << 8 | lt.tm_mday,
+            22: lambda: lt.tm_year,
+            24: lambda: f88(self.tr),
+            25: lambda: f88(self.tboiler),
+            26: lambda: f88(self.tdhw),
+            27: lambda: f88(self.toutside),
+            28: lambda: f88(self.tret),
+            33: lambda: int(self.tboiler + 15) & 0xffff if self.flame else 0,
+            56: lambda: f88(self.tdhwset),
+            57: lambda: f88(self.maxtset),
+            116: lambda: self.burner_starts & 0xffff,
+            117: lambda: self.ch_pump_starts & 0xffff,
+            118: lambda: self.dhw_pump_starts & 0xffff,
+            119: lambda: self.dhw_burner_starts & 0xffff,
+            120: lambda: int(self.burner_s / 3600) & 0xffff,
+            121: lambda: int(self.ch_pump_s / 3600) & 0xffff,
+            122: lambda: int(self.dhw_pump_s / 3600) & 0xffff,
+            123: lambda: int(self.dhw_burner_s / 3600) & 0xffff,
+            124: lambda: 0x0233,
+            126: lambda: 0x0302,
+        }
+        f = values.get(data_id)
+        return f() if f else STATIC.get(data_id, 0)
+
+
+class Simulator:
+    """Master/slave exchanges of one gateway.
+
+    'invalid': fraction of corrupted frames, 'unknown': fraction of
+    exchanges with an unknown register, 'dt': simulated seconds per exchange.
+    """
+
+    def __init__(self, seed=None, invalid=0.01, unknown=0.002, dt=1.0, t=None):
+        self.rng = random.Random(seed)
+        self.boiler = Boiler(self.rng, t)
+        self.invalid = invalid
+        self.unknown = unknown
+        self.dt = dt
+        self.n = 0
+        self.corrupted = 0
+        self.rare = sorted(r for r in OT if r not in FREQUENT and r != 0)
+        self.unknowns = [r for r in range(256) if r not in OT]
+
+    def data_id(self):
+        """Next register polled by the master."""
+        self.n += 1
+        if self.n % 2:
+            return 0
+        if self.rng.random() < self.unknown:
+            return self.rng.choice(self.unknowns)
+        if self.n % 20 == 0:
+            return self.rng.choice(self.rare)
+        return FREQUENT[(self.n // 2) % len(FREQUENT)]
+
+    def corrupt(self, raw, ms):
+        """Corrupt frame 'raw' from "m" or "s" to one which fails validation."""
+        self.corrupted += 1
+        kind = self.rng.randrange(3)
+        if kind == 0:
+            return raw ^ (1 << self.rng.randrange(32))  # Parity
+        if kind == 1:
+            raw |= 1 << self.rng.randrange(24, 28)  # Spare bits
+        else:
+            raw = raw & ~0x70000000 | (READ_ACK if ms == "m" else READ_DATA) << 28
+        return raw & 0x7fffffff | parity(raw & 0x7fffffff) << 31
+
+    def exchange(self):
+        """Advance the model one step, return (master frame, slave frame)."""
+        self.boiler.step(self.dt)
+        reg = self.data_id()
+        if reg not in OT:
+            m = frame(READ_DATA, reg, 0)
+            s = frame(UNKNOWN_DATAID, reg, 0)
+        elif writes(reg):
+            value = self.boiler.value(reg)
+            m = frame(WRITE_DATA, reg, value)
+            s = frame(WRITE_ACK, reg, value)
+        else:
+            value = self.boiler.value(reg)
+            m = frame(READ_DATA, reg, value & 0xff00 if reg == 0 else 0)
+            s = frame(READ_ACK, reg, value)
+        if self.rng.random() < self.invalid:
+            m = self.corrupt(m, "m")
+        if self.rng.random() < self.invalid:
+            s = self.corrupt(s, "s")
+        return m, s
+
+    def messages(self, t_esp, n):
+        """The MQTT messages (topic, payload) of 'n' exchanges."""
+        for _ in range(n):
+            m, s = self.exchange()
+            yield f"{t_esp}/master", f"{m:08X}"
+            yield f"{t_esp}/slave", f"{s:08X}"
+
+
+async def simulate(client, t_esp, sim, rate, duration=0, ts=True):
+    """Publish exchanges of 'sim' at 'rate' per second, 'duration' 0: forever."""
+    from .latency import now_ms, publish_properties
+    loop = asyncio.get_running_loop()
+    period = 1.0 / rate
+    start = next_t = loop.time() + sim.rng.uniform(0, period)
+    n = 0
+    while not duration or loop.time() - start < duration:
+        await asyncio.sleep(max(0.0, next_t - loop.time()))
+        next_t += period
+        kwargs = {"properties": publish_properties(now_ms())} if ts else {}
+        for topic, payload in sim.messages(t_esp, 1):
+            await client.publish(topic, payload=payload, **kwargs)
+        n += 1
+    return n
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog="otmqtt-sim",
+        description="Synthetic OpenTherm traffic, a stand-in for ESP gateways.")
+    parser.add_argument("-C", "--config", metavar="mqtt_ot.ini",
+                        default="mqtt_ot.ini",
+                        help=".ini file with MQTT settings and gateways")
+    parser.add_argument("-g", "--gateways", type=int, default=0,
+                        help="number of gateways '<OTGW_topic><n>' (def. from config)")
+    parser.add_argument("-r", "--rate", type=float, default=1.0,
+                        help="exchanges per second per gateway (def. 1)")
+    parser.add_argument("-i", "--invalid", type=float, default=0.01,
+                        help="fraction of corrupted frames (def. 0.01)")
+    parser.add_argument("-d", "--duration", type=float, default=0,
+                        help="duration in seconds (def. 0: forever)")
+    parser.add_argument("-s", "--seed", type=int, default=None,
+                        help="random seed")
+    parser.add_argument("--dt", type=float, default=1.0,
+                        help="simulated seconds per exchange (def. 1)")
+    return parser.parse_args()
+
+
+async def run(args, config):
+    import aiomqtt
+    import paho.mqtt.client as mqtt
+    from .fleet import parse_gateways
+    mc = config["MQTT"]
+    if args.gateways:
+        topics = [f"{mc['OTGW_topic']}{n}" for n in range(args.gateways)]
+    else:
+        topics = [t_esp for t_esp, _ in parse_gateways(config)]
+    sims = [Simulator(None if args.seed is None else args.seed + n,
+                      invalid=args.invalid, dt=args.dt)
+            for n in range(len(topics))]
+    async with aiomqtt.Client(
+            hostname=mc["host"], port=int(mc["port"]),
+            username=mc["username"], password=mc["password"],
+            protocol=mqtt.MQTTv5) as client:
+        for t_esp in topics:
+            await client.publish(f"{t_esp}/state", payload="online", retain=True)
+        t0 = time.monotonic()
+        counts = await asyncio.gather(*(simulate(client, t_esp, sim, args.rate, args.duration)
+                                        for t_esp, sim in zip(topics, sims)))
+        elapsed = time.monotonic() - t0
+    n = sum(counts)
+    print(f"{len(topics)} gateways, {n} exchanges in {elapsed:.1f}s "
+          f"({2 * n / elapsed:.0f} frames/s), "
+          f"{sum(s.corrupted for s in sims)} corrupted frames")
+    return 0
+
+
+def main():
+    from .otmqtt import read_config
+    args = parse_arguments()
+    config = read_config(args)
+    try:
+        return asyncio.run(run(args, config))
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+"""Staleness detection of registers, using a hashed timer wheel.
+
+Each tracked key, e.g. (gateway, direction, data_id), learns its normal
+update interval: an exponential moving average and a slowly decaying peak
+of the intervals between updates. After 'learn' updates, every update
+(re)schedules a timeout of 'factor' times the larger of both, clamped to
+[min_timeout, max_timeout]. Without an update before the timeout the key
+is stale, until its next update.
+
+The intervals are those between the updates seen, for otmqtt the frames
+forwarded by the gateway, i.e. the changes of a register. A register which
+keeps the same value for longer than its learned timeout is reported
+stale, so only track registers which change regularly.
+
+The timer wheel has a slot per tick; scheduling, rescheduling and expiry
+cost O(1) per timer, independent of the number of timers.
+"""
+
+
+class TimerWheel:
+    """Hashed timer wheel with 'slots' slots of 'tick' seconds."""
+
+    def __init__(self, tick=1.0, slots=1024):
+        self.tick = tick
+        self.wheel = [{} for _ in range(slots)]  # key -> deadline tick
+        self.slot_of = {}  # key -> slot
+        self.current = None  # Last processed tick
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def schedule(self, key, deadline):
+        """(Re)schedule the timer of 'key' at time 'deadline' (s)."""
+        self.cancel(key)
+        t = int(deadline / self.tick)
+        if self.current is not None:
+            t = max(t, self.current + 1)
+        slot = t % len(self.wheel)
+        self.wheel[slot][key] = t
+        self.slot_of[key] = slot
+        return
+
+    def cancel(self, key):
+        slot = self.slot_of.pop(key, None)
+        if slot is not None:
+            del self.wheel[slot][key]
+        return
+
+    def advance(self, now):
+        """Advance to time 'now' (s), return the keys of the expired timers."""
+        target = int(now / self.tick)
+        if self.current is None:
+            self.current = target - 1
+        expired = []
+        n = len(self.wheel)
+        for t in range(self.current + 1, min(target, self.current + n) + 1):
+            timers = self.wheel[t % n]
+            keys = [k for k, kt in timers.items() if kt <= target]
+            for k in keys:
+                del timers[k]
+                del self.slot_of[k]
+            expired += keys
+        self.current = max(self.current, target)
+        return expired
+
+
+class Entry:
+    __slots__ = ("last", "interval", "peak", "n", "stale")
+
+    def __init__(self, now):
+        self.last = now
+        self.interval = 0.0
+        self.peak = 0.0
+        self.n = 1
+        self.stale = False
+
+
+class StalenessTracker:
+    """Learn the update interval of keys, detect keys which stopped updating."""
+
+    def __init__(self, factor=3.0, min_timeout=30.0, max_timeout=3600.0,
+                 learn=3, alpha=0.2, decay=0.99, tick=1.0):
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.learn = learn
+        self.alpha = alpha
+        self.decay = decay
+        self.wheel = TimerWheel(tick)
+        self.entries = {}
+
+    def seen(self, key, now):
+        """Update of 'key' at 'now' (s), return True if new or no longer stale."""
+        e = self.entries.get(key)
+        if e is None:
+            self.entries[key] = Entry(now)
+            return True
+        recovered = e.stale
+        dt = now - e.last
+        e.last = now
+        e.stale = False
+        if not recovered:
+            # Do not learn from the gap of a stale key
+            e.n += 1
+            e.interval = dt if e.n == 2 else e.interval + self.alpha * (dt - e.interval)
+            e.peak = max(dt, e.peak * self.decay)
+        if e.n >= self.learn:
+            self.wheel.schedule(key, now + self.timeout(e))
+        return recovered
+
+    def forget(self, keys):
+        """Stop tracking 'keys'."""
+        for k in keys:
+            self.wheel.cancel(k)
+            del self.entries[k]
+        return
+
+    def timeout(self, e):
+        t = self.factor * max(e.interval, e.peak)
+        return min(self.max_timeout, max(self.min_timeout, t))
+
+    def expire(self, now):
+        """The keys which became stale at 'now' (s)."""
+        keys = self.wheel.advance(now)
+        for k in keys:
+            self.entries[k].stale = True
+        return keys
+
+    def report(self):
+        return {
+            "tracked": len(self.entries),
+            "scheduled": len(self.wheel),
+            "stale": sum(e.stale for e in self.entries.values()),
+        }
+
+
+if __name__ == "__main__":
+    st = StalenessTracker(min_timeout=1)
+    for t in range(10):
+        st.seen("a", t)
+        st.seen("b", t * 2)
+        print(t, st.expire(t))
+    for t in range(10, 40):
+        print(t, st.expire(t))
+    print(st.report())
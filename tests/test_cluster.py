@@ -0,0 +1,104 @@
+"""Leader election and gateway assignment on an in-process broker."""
+import asyncio
+import collections
+from otmqtt.cluster import Assignment, Election, LocalBroker
+
+GATEWAYS = [f"esp/gw{i}" for i in range(6)]
+LEASE = 0.6
+
+
+async def instance(broker, name, frames):
+    """Instance 'name' of the cluster, the frames received are added to 'frames'."""
+    client = broker.client(name, will=("otgw/state", b"offline", True))
+    election = Election(name, "otgw", lease=LEASE)
+    assignment = Assignment(name, "otgw", GATEWAYS, lease=LEASE)
+    for t in ("otgw/leader", "otgw/state", "otgw/member", "otgw/assign"):
+        await client.subscribe(t)
+
+    async def on_change(added, removed):
+        for gw in removed:
+            await client.unsubscribe(f"{gw}/slave")
+        for gw in added:
+            await client.subscribe(f"{gw}/slave")
+
+    async def receive():
+        async for topic, payload in client.messages():
+            if topic == "otgw/leader":
+                election.on_leader(payload)
+            elif topic == "otgw/state":
+                await election.on_state(client, payload)
+            elif topic == "otgw/member":
+                assignment.on_member(payload)
+            elif topic == "otgw/assign":
+                assignment.on_assign(payload)
+            else:
+                frames[topic].append(name)
+    tasks = [asyncio.create_task(election.run(client, grace=0.1)),
+             asyncio.create_task(assignment.run(client, election, on_change)),
+             asyncio.create_task(receive())]
+    return client, election, tasks
+
+
+async def send(broker, frames):
+    """Instances receiving a frame, per gateway."""
+    frames.clear()
+    for gw in GATEWAYS:
+        await broker.publish(f"{gw}/slave", b"40190000", False)
+    await asyncio.sleep(0.05)
+    return {gw: frames[f"{gw}/slave"] for gw in GATEWAYS}
+
+
+async def crash(node):
+    client, _, tasks = node
+    await client.crash()
+    for t in tasks:
+        t.cancel()
+    return
+
+
+def leaders(nodes):
+    return [e.instance for c, e, _ in nodes if e.is_leader and c.connected]
+
+
+def test_leader_failover():
+    async def scenario():
+        broker = LocalBroker()
+        nodes = [await instance(broker, f"node{i}", collections.defaultdict(list))
+                 for i in range(3)]
+        await asyncio.sleep(1.0)
+        first = leaders(nodes)
+        assert len(first) == 1
+        assert broker.retained["otgw/state"] == b"online"
+        await crash(next(n for n in nodes if n[1].is_leader))
+        assert broker.retained["otgw/state"] == b"offline"
+        await asyncio.sleep(1.5)
+        second = leaders(nodes)
+        assert len(second) == 1 and second != first
+        assert broker.retained["otgw/state"] == b"online"
+        for n in nodes:
+            await crash(n)
+    asyncio.run(scenario())
+
+
+def test_gateway_reassignment():
+    async def scenario():
+        broker = LocalBroker()
+        frames = collections.defaultdict(list)
+        nodes = [await instance(broker, f"node{i}", frames) for i in range(3)]
+        await asyncio.sleep(1.5)
+        received = await send(broker, frames)
+        # Each frame is decoded by exactly one instance
+        assert all(len(names) == 1 for names in received.values())
+        # A follower crashes, its gateways move to the others
+        follower = next(n for n in nodes if not n[1].is_leader)
+        lost = [gw for gw, names in received.items() if names == [follower[0].name]]
+        assert lost
+        await crash(follower)
+        await asyncio.sleep(2.0)
+        received = await send(broker, frames)
+        assert all(len(names) == 1 for names in received.values())
+        assert all(follower[0].name not in names for names in received.values())
+        assert all(received[gw] for gw in lost)
+        for n in nodes:
+            await crash(n)
+    asyncio.run(scenario())
@@ -0,0 +1,84 @@
+"""Notifier retries and burst merging against the local webhook stand-in."""
+import asyncio
+import pytest
+from otmqtt.notifier import Notifier, WebhookStandIn, WebhookTarget
+
+
+@pytest.fixture
+def hook(request):
+    stand_in = WebhookStandIn(fail=getattr(request, "param", 0))
+    yield stand_in
+    stand_in.close()
+
+
+async def wait_until(cond, timeout=5.0):
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    while not cond() and loop.time() < end:
+        await asyncio.sleep(0.01)
+    return cond()
+
+
+def run(notifier, scenario):
+    async def main():
+        task = asyncio.create_task(notifier.run())
+        try:
+            await scenario()
+        finally:
+            task.cancel()
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("hook", [2], indirect=True)
+def test_retry(hook):
+    notifier = Notifier([WebhookTarget(hook.url)], rate=0, burst=0.01, backoff=0.01)
+
+    async def scenario():
+        notifier.notify("Boiler fault")
+        assert await wait_until(lambda: hook.received)
+    run(notifier, scenario)
+    assert hook.received == [{"text": "Boiler fault"}]
+    assert hook.fail == 0
+    assert notifier.stats()["failed"] == 0
+
+
+@pytest.mark.parametrize("hook", [10], indirect=True)
+def test_retries_exhausted(hook):
+    notifier = Notifier([WebhookTarget(hook.url)], rate=0, burst=0.01, retries=2,
+                        backoff=0.01)
+
+    async def scenario():
+        notifier.notify("Boiler fault")
+        assert await wait_until(lambda: notifier.failed)
+    run(notifier, scenario)
+    assert hook.received == []
+    assert hook.fail == 7  # The first send and 2 retries
+    assert notifier.stats()["failed"] == 1
+
+
+def test_burst_merged(hook):
+    notifier = Notifier([WebhookTarget(hook.url)], rate=0, burst=0.2, max_lines=3)
+
+    async def scenario():
+        for i in range(5):
+            notifier.notify(f"Boiler fault {i}")
+        assert await wait_until(lambda: hook.received)
+        notifier.notify("Gateway esp/mqtt_ot: online")
+        assert await wait_until(lambda: len(hook.received) == 2)
+    run(notifier, scenario)
+    assert hook.received == [
+        {"text": "Boiler fault 0\nBoiler fault 1\nBoiler fault 2\n... and 2 more"},
+        {"text": "Gateway esp/mqtt_ot: online"}]
+    assert notifier.stats()["sent"] == 2
+
+
+def test_invalid_url(hook):
+    notifier = Notifier([WebhookTarget("http://127.0.0.1:port/hook"), WebhookTarget(hook.url)],
+                        rate=0, burst=0.01, retries=0, backoff=0.01)
+
+    async def scenario():
+        notifier.notify("Boiler fault")
+        assert await wait_until(lambda: hook.received)
+        notifier.notify("Gateway esp/mqtt_ot: online")
+        assert await wait_until(lambda: len(hook.received) == 2 and notifier.failed == 2)
+    run(notifier, scenario)
@@ -0,0 +1,45 @@
+"""Simulated frames against the validation of received frames."""
+from otmqtt.opentherm import OpenThermApplProtocol
+from otmqtt.ot_registers import OT
+from otmqtt.simulator import Simulator
+
+validate = OpenThermApplProtocol.validate
+
+
+def test_frames_valid():
+    sim = Simulator(seed=1, invalid=0, unknown=0)
+    for _ in range(2000):
+        m, s = sim.exchange()
+        assert validate(m, "m") is None, f"{m:08X}"
+        assert validate(s, "s") is None, f"{s:08X}"
+        assert (m >> 16) & 0xff == (s >> 16) & 0xff
+        assert (m >> 16) & 0xff in OT
+
+
+def test_corrupted_frames_invalid():
+    sim = Simulator(seed=2, invalid=1.0, unknown=0)
+    for _ in range(2000):
+        m, s = sim.exchange()
+        assert validate(m, "m") in ("parity", "spare", "msg_type"), f"{m:08X}"
+        assert validate(s, "s") in ("parity", "spare", "msg_type"), f"{s:08X}"
+    assert sim.corrupted == 4000
+
+
+def test_unknown_registers():
+    sim = Simulator(seed=3, invalid=0, unknown=1.0)
+    for _ in range(200):
+        m, s = sim.exchange()
+        assert validate(m, "m") is None
+        if (s >> 16) & 0xff in OT:
+            assert validate(s, "s") is None
+        else:
+            assert validate(s, "s") == "unknown_id"
+
+
+def test_messages():
+    sim = Simulator(seed=4, invalid=0, unknown=0)
+    msgs = list(sim.messages("esp/mqtt_ot", 10))
+    assert [t for t, _ in msgs] == ["esp/mqtt_ot/master", "esp/mqtt_ot/slave"] * 10
+    for t, p in msgs:
+        ms = "s" if t.endswith("/slave") else "m"
+        assert validate(int(p, 16), ms) is None